@@ -1,30 +1,14 @@
 import json
-from flask import Flask, request, send_file
-import os
-from synthesis import load_encoder, load_vocoder, synthesize_text, write_signal_to_file
-import dynet_config
+from flask import Flask, Response, request, send_file
+from synthesis import configure_dynet, load_all_models, synthesize_text, tune_models, write_signal_to_file
 import sys
 import optparse
+from profiling import profiler, parse_window, metrics
 
 
 encoders = {}
 vocoders = {}
-
-
-def load_all_models(base_path):
-    global encoders, vocoders
-
-    for lang in os.listdir(base_path):
-        new_path = '%s/%s' % (base_path, lang)
-        if os.path.isdir(new_path):
-            try:
-                encoder = load_encoder(params, new_path)
-                vocoder = load_vocoder(params, new_path)
-
-                encoders[lang] = encoder
-                vocoders[lang] = vocoder
-            except:
-                print('Language %s does not have all models' % lang)
+worker_pool = None
 
 
 app = Flask(__name__)
@@ -35,6 +19,15 @@ def health_check():
     return json.dumps({'success': True}), 200, {'ContentType': 'application/json'}
 
 
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    if worker_pool is not None:
+        counters = worker_pool.metrics()
+    else:
+        counters = metrics.snapshot()
+    return json.dumps(counters), 200, {'ContentType': 'application/json'}
+
+
 @app.route('/synthesis', methods=['GET'])
 def get_wav():
     out_file = 'out.wav'
@@ -45,7 +38,11 @@ def get_wav():
     except:
         return json.dumps({'error': 'language not set'}), 400, {'ContentType': 'application/json'}
 
-    if language not in encoders:
+    if worker_pool is not None:
+        languages = worker_pool.languages
+    else:
+        languages = encoders
+    if language not in languages:
         return json.dumps({'error': 'language not found'}), 400, {'ContentType': 'application/json'}
 
     try:
@@ -60,8 +57,20 @@ def get_wav():
 
     print(language, text, speaker_identity)
 
-    signal = synthesize_text(text, encoders[language], vocoders[language], speaker_identity)
-    write_signal_to_file(signal, out_file, params)
+    if worker_pool is not None:
+        from serving import WorkerError
+        try:
+            with profiler.stage('request'):
+                wav = worker_pool.synthesize(language, text, speaker_identity)
+        except WorkerError as e:
+            return json.dumps({'error': 'synthesis failed: ' + str(e)}), 500, {'ContentType': 'application/json'}
+        profiler.step()
+        return Response(wav, mimetype='audio/wav')
+
+    with profiler.stage('request'):
+        signal = synthesize_text(text, encoders[language], vocoders[language], speaker_identity,
+                                 chunk_size=params.chunk_size)
+        write_signal_to_file(signal, out_file, params)
 
     return send_file('../%s' % out_file, mimetype='audio/wav')
 
@@ -82,11 +91,48 @@ if __name__ == '__main__':
                       help='Resample input files at this rate (default=24000)', type='int', default=24000)
     parser.add_option("--set-mem", action='store', dest='memory', default='2048', type='int',
                       help='preallocate memory for batch training (default 2048)')
+    parser.add_option('--workers', action='store', dest='workers', type='int', default=0,
+                      help='Run the models in N separate worker processes (default=0 - run inside the WebService)')
+    parser.add_option('--buffer-seconds', action='store', dest='buffer_seconds', type='int', default=30,
+                      help='Size (in seconds of audio) of the shared buffer used by each worker (default=30)')
+    parser.add_option('--threads', action='store', dest='threads', type='int', default=0,
+                      help='Number of CPU threads per model process (default=0 - split all cores between processes)')
+    parser.add_option('--chunk-size', action='store', dest='chunk_size', type='int', default=-1,
+                      help='Vocode the spectrogram in chunks of N frames (default=-1 - whole utterance)')
+    parser.add_option('--autotune', action='store_true', dest='autotune',
+                      help='Warm-up the models and select the fastest thread count and chunk size')
+    parser.add_option('--profile', action='store', dest='profile',
+                      help='Write per-stage wall/CPU timings (Chrome trace format) to this folder')
+    parser.add_option('--profile-window', action='store', dest='profile_window',
+                      help='Also capture cProfile and PyTorch traces for requests START:STOP (e.g. 10:20)')
+    parser.add_option('--attention-window', action='store', dest='attention_window', type='int', default=0,
+                      help='Score only N characters on each side of the current attention position (default=0 - all)')
+    parser.add_option('--encoder-engine', action='store', dest='encoder_engine', choices=['dynet', 'numpy'],
+                      default='dynet', help='Run the encoder with DyNet or with the NumPy runtime (default=dynet)')
+    parser.add_option('--encoder-weights', action='store', dest='encoder_weights', default='rnn_encoder',
+                      help='Weights used by the NumPy encoder, e.g. rnn_encoder.svd (default=rnn_encoder)')
+    parser.add_option('--encoder-cache', action='store', dest='encoder_cache', type='int', default=0,
+                      help='Keep the encoder states of the last N inputs and reuse them for other speakers (default=0)')
     params, _ = parser.parse_args(sys.argv)
 
-    dynet_config.set(mem=params.memory, random_seed=9)
+    if params.profile:
+        profiler.start(params.profile, window=parse_window(params.profile_window))
+
+    from tuning import configure_threads, cpu_count
+    if params.threads <= 0:
+        params.threads = max(cpu_count() // max(params.workers, 1), 1)
 
     models_base_path = 'data/models'
-    load_all_models(models_base_path)
+    if params.workers > 0:
+        from serving import WorkerPool
+        worker_pool = WorkerPool(params, models_base_path, params.workers,
+                                 params.buffer_seconds * params.target_sample_rate)
+    else:
+        configure_threads(params.threads)
+        configure_dynet(params)
+        encoders, vocoders = load_all_models(params, models_base_path)
+        if len(encoders) != 0:
+            language = sorted(encoders.keys())[0]
+            tune_models(encoders[language], vocoders[language], params)
 
     app.run(host=params.host, port=params.port)
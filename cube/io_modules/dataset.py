@@ -1,5 +1,3 @@
-import scipy
-import scipy.io.wavfile
 import numpy as np
 import sys
 
@@ -59,6 +57,7 @@ class DatasetIO:
 
     def read_wave(self, filename, sample_rate=None):
         if sample_rate is None:
+            import scipy.io.wavfile
             sr, wav = scipy.io.wavfile.read(filename)
             wav = np.asarray(wav, dtype=np.float)
             if wav.dtype != np.float and wav.dtype != np.double:
@@ -70,6 +69,7 @@ class DatasetIO:
         return wav, sr
 
     def write_wave(self, filename, data, sample_rate, dtype=np.float):
+        import scipy.io.wavfile
         wav_decoded = np.asarray(data, dtype=dtype)
         scipy.io.wavfile.write(filename, sample_rate, wav_decoded)
 
@@ -161,6 +161,29 @@ class DatasetIO:
         return out
 
 
+class WaveWriter:
+    """
+    Writes a 16-bit mono WAVE file incrementally, so the whole signal never has to be kept in memory
+    """
+
+    def __init__(self, filename, sample_rate):
+        import wave
+        self._wav = wave.open(filename, 'wb')
+        self._wav.setnchannels(1)
+        self._wav.setsampwidth(2)
+        self._wav.setframerate(sample_rate)
+
+    def write(self, signal):
+        pcm = np.clip(signal, -32768, 32767).astype('<i2')
+        self._wav.writeframes(pcm.tobytes())
+
+    def write_silence(self, num_samples):
+        self._wav.writeframes(bytes(2 * num_samples))
+
+    def close(self):
+        self._wav.close()
+
+
 class Dataset:
     def __init__(self, folder):
         from os import listdir
@@ -177,6 +200,63 @@ class Dataset:
         self.files = final_list
 
 
+def load_utterance(file):
+    """
+    Reads the phones (.lab) and the spectrogram (.mgc.npy) of a training file
+    """
+    return DatasetIO().read_lab(file + '.lab'), np.load(file + '.mgc.npy')
+
+
+def load_utterances(files):
+    return [load_utterance(file) for file in files]
+
+
+class DataLoader:
+    """
+    Iterates over (item, load_func(item)) for each item, in order. Upcoming items are loaded by background workers
+    (threads, or processes if processes=True, in which case load_func must be a module-level function), with at most
+    prefetch items in flight. With num_workers=0 items are loaded synchronously.
+    """
+
+    def __init__(self, items, load_func, num_workers=2, prefetch=8, processes=False):
+        self.items = items
+        self.load_func = load_func
+        self.num_workers = num_workers
+        self.prefetch = max(prefetch, 1)
+        self.processes = processes
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        if self.num_workers == 0:
+            for item in self.items:
+                yield item, self.load_func(item)
+            return
+
+        from collections import deque
+        if self.processes:
+            from concurrent.futures import ProcessPoolExecutor as Executor
+        else:
+            from concurrent.futures import ThreadPoolExecutor as Executor
+        pending = deque()
+        executor = Executor(max_workers=self.num_workers)
+        try:
+            for item in self.items:
+                pending.append((item, executor.submit(self.load_func, item)))
+                if len(pending) >= self.prefetch:
+                    item, future = pending.popleft()
+                    yield item, future.result()
+            while len(pending) != 0:
+                item, future = pending.popleft()
+                yield item, future.result()
+        finally:
+            # the consumer may stop early: drop whatever was not started yet
+            for _, future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+
 class PhoneInfo:
     context2int = {}
 
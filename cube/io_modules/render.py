@@ -0,0 +1,52 @@
+#
+# Author: Tiberiu Boros
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import numpy as np
+
+
+def _save_bitmap(bitmap, output_file):
+    from PIL import Image
+    img = Image.fromarray(bitmap, 'L')
+    img.save(output_file)
+
+
+def spectrogram_bitmap(mgc, normalize=False, flip=True):
+    """
+    Converts a (frames x channels) spectrogram into an 8-bit grayscale bitmap with time on the horizontal axis.
+    Values are expected in [0, 1], unless normalize is set, in which case they are min-max scaled. With flip, the
+    lowest channel is drawn at the bottom of the image.
+    """
+    mgc = np.asarray(mgc, dtype=np.float32)
+    if normalize:
+        mgc_min = mgc.min()
+        mgc_max = mgc.max()
+        mgc = (mgc - mgc_min) / max(mgc_max - mgc_min, 1e-8)
+    bitmap = np.clip(mgc * 255, 0, 255).astype(np.uint8).transpose()
+    if flip:
+        bitmap = bitmap[::-1]
+    return np.ascontiguousarray(bitmap)
+
+
+def render_spectrogram(mgc, output_file, normalize=False, flip=True):
+    _save_bitmap(spectrogram_bitmap(mgc, normalize=normalize, flip=flip), output_file)
+
+
+def render_attention(att, output_file):
+    """
+    Renders a (decoder steps x encoder steps) attention matrix, one decoder step per row
+    """
+    bitmap = np.clip(np.asarray(att, dtype=np.float32) * 255, 0, 255).astype(np.uint8)
+    _save_bitmap(np.ascontiguousarray(bitmap), output_file)
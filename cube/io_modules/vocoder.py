@@ -16,9 +16,9 @@
 
 # import pyworld as pw
 import numpy as np
-import librosa
-from scipy import signal
-from tqdm import tqdm
+
+
+# librosa, scipy and tqdm are slow to import, so they are only loaded by the methods that need them
 
 
 class WorldVocoder:
@@ -59,13 +59,17 @@ class MelVocoder:
         return self._normalize(S).transpose()
 
     def preemphasis(self, x):
-        return signal.lfilter([1, -0.97], [1], x)
+        # same as scipy.signal.lfilter([1, -0.97], [1], x)
+        x = np.asarray(x)
+        return np.concatenate([x[:1], x[1:] - 0.97 * x[:-1]])
 
     def _istft(self, y, sample_rate):
+        import librosa
         n_fft, hop_length, win_length = self._stft_parameters(sample_rate)
         return librosa.istft(y, hop_length=hop_length, win_length=win_length)
 
     def _stft(self, y, sample_rate):
+        import librosa
         n_fft, hop_length, win_length = self._stft_parameters(sample_rate)
         return librosa.stft(y=y, n_fft=n_fft, hop_length=hop_length, win_length=win_length, window='hann')
 
@@ -75,6 +79,7 @@ class MelVocoder:
         return np.dot(self._mel_basis, spectrogram)
 
     def _build_mel_basis(self, sample_rate, num_mels):
+        import librosa
         n_fft = 1024
         return librosa.filters.mel(sample_rate, n_fft, n_mels=num_mels)
 
@@ -97,6 +102,8 @@ class MelVocoder:
         return self._griffinlim(spectrogram.transpose(), n_iter=n_iter, n_fft=n_fft, hop_length=hop_length)
 
     def _griffinlim(self, spectrogram, n_iter=100, window='hann', n_fft=2048, hop_length=-1, verbose=False):
+        import librosa
+        from tqdm import tqdm
         if hop_length == -1:
             hop_length = n_fft // 4
 
@@ -14,14 +14,33 @@
 # limitations under the License.
 #
 
+import os
+
 import dynet as dy
 import numpy as np
 
 
+def read_encoder_config(output_base):
+    """
+    Reads the hyperparameters stored in <output_base>.conf. Models saved before this file existed emit 3 frames per
+    decoder step.
+    """
+    config = {'frames_per_step': 3}
+    if os.path.exists(output_base + '.conf'):
+        with open(output_base + '.conf') as f:
+            for line in f:
+                parts = line.strip().split('\t')
+                if len(parts) == 2:
+                    config[parts[0]] = int(parts[1])
+    return config
+
+
 class Encoder:
-    def __init__(self, params, encodings, model=None, runtime=False):
+    def __init__(self, params, encodings, model=None, runtime=False, frames_per_step=3):
         self.model = model
         self.params = params
+        # number of mgc frames emitted by each decoder step
+        self.FRAMES_PER_STEP = frames_per_step
         self.PHONE_EMBEDDINGS_SIZE = 100
         self.SPEAKER_EMBEDDINGS_SIZE = 200
         self.ENCODER_SIZE = 256
@@ -29,6 +48,10 @@ class Encoder:
         self.DECODER_SIZE = 1024
         self.DECODER_LAYERS = 2
         self.MGC_PROJ_SIZE = 100
+        # at runtime, score only this many characters on each side of the current position (0 - score all of them)
+        self.attention_window = 0
+        # optional models.utils.LRUCache of BiLSTM outputs, used at runtime only
+        self.encoder_cache = None
         self.encodings = encodings
         from models.utils import orthonormal_VanillaLSTMBuilder
         lstm_builder = orthonormal_VanillaLSTMBuilder
@@ -71,12 +94,11 @@ class Encoder:
         self.hid_w = self.model.add_parameters((500, self.DECODER_SIZE))
         self.hid_b = self.model.add_parameters((500))
 
-        self.proj_w_1 = self.model.add_parameters((params.mgc_order, 500))
-        self.proj_b_1 = self.model.add_parameters((params.mgc_order))
-        self.proj_w_2 = self.model.add_parameters((params.mgc_order, 500))
-        self.proj_b_2 = self.model.add_parameters((params.mgc_order))
-        self.proj_w_3 = self.model.add_parameters((params.mgc_order, 500))
-        self.proj_b_3 = self.model.add_parameters((params.mgc_order))
+        self.proj_w = []
+        self.proj_b = []
+        for _ in range(self.FRAMES_PER_STEP):
+            self.proj_w.append(self.model.add_parameters((params.mgc_order, 500)))
+            self.proj_b.append(self.model.add_parameters((params.mgc_order)))
 
         self.highway_w = self.model.add_parameters(
             (params.mgc_order, self.ENCODER_SIZE * 2 + self.SPEAKER_EMBEDDINGS_SIZE))
@@ -119,44 +141,85 @@ class Encoder:
                     return self.speaker_lookup[self.encodings.speaker2int[feature]]
         return None
 
+    def _encode(self, characters, runtime=False):
+        cache_key = None
+        x_input = None
+        if runtime and self.encoder_cache is not None:
+            # the BiLSTM outputs do not depend on the speaker, so they are shared by all voices
+            from models.utils import encoder_input_key
+            cache_key = encoder_input_key(characters, self.encodings)
+            cached = self.encoder_cache.get(cache_key)
+            if cached is not None:
+                x_input = [dy.inputVector(x) for x in cached]
+
+        if x_input is None:
+            x_input = self._make_input(characters)
+            for lstm_fw, lstm_bw in zip(self.encoder_fw, self.encoder_bw):
+                x_fw = lstm_fw.initial_state().transduce(x_input)
+                x_bw = lstm_bw.initial_state().transduce(reversed(x_input))
+                x_input = [dy.concatenate([fw, bw]) for fw, bw in zip(x_fw, reversed(x_bw))]
+            if cache_key is not None:
+                self.encoder_cache.put(cache_key, dy.concatenate_cols(x_input).npvalue().transpose().copy())
+
+        x_speaker = self._get_speaker_embedding(characters)
+        final_input = []
+        for x in x_input:
+            final_input.append(dy.concatenate([x, x_speaker]))
+        return final_input
+
     def _predict(self, characters, gold_mgc=None, max_size=-1):
+        output_mgc = []
+        output_stop = []
+        output_att = []
+        for outputs, stop, align, _ in self._decode_steps(characters, gold_mgc=gold_mgc, max_size=max_size):
+            output_mgc.extend(outputs)
+            output_stop.append(stop)
+            output_att.append(align)
+        return output_mgc, output_stop, output_att
+
+    def _decode_steps(self, characters, gold_mgc=None, max_size=-1, first_step=0, num_steps=-1,
+                      decoder_state=None):
+        """
+        Runs the decoder and yields the ([FRAMES_PER_STEP mgc frames], stop, alignment, decoder state) of each step,
+        as soon as the step is built. With teacher forcing, decoding can also start at first_step from a saved
+        decoder state (NumPy values of decoder.s()) and stop after num_steps steps.
+        """
         if gold_mgc is None:
             runtime = True
         else:
             runtime = False
 
-        mgc_index = 0
-        output_mgc = []
-        output_stop = []
-        # aux_output_mgc = []
-        output_att = []
+        mgc_index = first_step * self.FRAMES_PER_STEP
         last_mgc = self.start_lookup[0]
+        if first_step != 0:
+            last_mgc = dy.inputVector(gold_mgc[min(mgc_index - 1, len(gold_mgc) - 1)])
 
-        # encoder
-        x_input = self._make_input(characters)
-        for lstm_fw, lstm_bw in zip(self.encoder_fw, self.encoder_bw):
-            x_fw = lstm_fw.initial_state().transduce(x_input)
-            x_bw = lstm_bw.initial_state().transduce(reversed(x_input))
-            x_input = [dy.concatenate([fw, bw]) for fw, bw in zip(x_fw, reversed(x_bw))]
+        encoder = self._encode(characters, runtime=runtime)
+        # the encoder-side attention projection does not depend on the decoder, so it is computed once per utterance
+        encoder_mat, encoder_keys = self._make_attention_keys(encoder)
 
-        x_speaker = self._get_speaker_embedding(characters)
-        final_input = []
-        for x in x_input:
-            final_input.append(dy.concatenate([x, x_speaker]))
-        encoder = final_input
-
-        decoder = self.decoder.initial_state().add_input(self.decoder_start_lookup[0])
+        if decoder_state is None:
+            decoder = self.decoder.initial_state().add_input(self.decoder_start_lookup[0])
+        else:
+            decoder = self.decoder.initial_state([dy.inputVector(value) for value in decoder_state])
         last_att_pos = None
+        monitor = None
         if gold_mgc is None:
+            from models.utils import AlignmentMonitor
             last_att_pos = 0
+            monitor = AlignmentMonitor(len(characters), self.FRAMES_PER_STEP, self.attention_window)
 
         stationed_count = 0
         first = 4
         # stationed_index = 0
         while True:
-            att, align = self._attend(encoder, decoder, last_att_pos)
-            if gold_mgc is None:
-                last_att_pos = np.argmax(align.value())
+            if runtime and self.attention_window > 0:
+                att, align, last_att_pos, attended = self._attend_window(encoder, encoder_mat, encoder_keys, decoder,
+                                                                         last_att_pos)
+            else:
+                att, align, attended = self._attend(encoder, encoder_mat, encoder_keys, decoder, last_att_pos)
+                if gold_mgc is None:
+                    last_att_pos = np.argmax(align.value())
             if runtime and first > 0:
                 last_att_pos = 0
                 first -= 1
@@ -166,128 +229,458 @@ class Encoder:
                 if stationed_count > 5:
                     break
 
-            output_att.append(align)
             # main output
             mgc_proj = dy.tanh(
                 self.last_mgc_proj_w.expr(update=True) * last_mgc + self.last_mgc_proj_b.expr(update=True))
             decoder = decoder.add_input(dy.concatenate([mgc_proj, att]))
             hidden = dy.tanh(self.hid_w.expr(update=True) * decoder.output() + self.hid_b.expr(update=True))
 
-            output = dy.logistic(
-                self.highway_w.expr(update=True) * att + self.proj_w_1.expr(update=True) * hidden + self.proj_b_1.expr(
-                    update=True))
-            output_mgc.append(output)
-            output = dy.logistic(
-                self.highway_w.expr(update=True) * att + self.proj_w_2.expr(update=True) * hidden + self.proj_b_2.expr(
-                    update=True))
-            output_mgc.append(output)
-            output = dy.logistic(
-                self.highway_w.expr(update=True) * att + self.proj_w_3.expr(update=True) * hidden + self.proj_b_3.expr(
-                    update=True))
-            output_mgc.append(output)
-
-            output_stop.append(
-                dy.tanh(self.stop_w.expr(update=True) * decoder.output() + self.stop_b.expr(update=True)))
+            outputs = []
+            highway = self.highway_w.expr(update=True) * att
+            for proj_w, proj_b in zip(self.proj_w, self.proj_b):
+                output = dy.logistic(highway + proj_w.expr(update=True) * hidden + proj_b.expr(update=True))
+                outputs.append(output)
+
+            stop = dy.tanh(self.stop_w.expr(update=True) * decoder.output() + self.stop_b.expr(update=True))
+            yield outputs, stop, align, decoder
+            num_steps -= 1
 
             if runtime:
                 if max_size != -1 and mgc_index > max_size:
                     break
                 last_mgc = dy.inputVector(output.value())
-                # print output_stop[-1].value()
-                if max_size == -1 and output_stop[-1].value() < -0.5:
+                stop_value = stop.value()
+                # print stop.value()
+                if max_size == -1 and stop_value < -0.5:
+                    break
+                if monitor.update(last_att_pos, stop_value, attended) is not None:
                     break
 
                 if mgc_index >= len(characters) * 7:  # safeguard
                     break
             else:
-                last_mgc = dy.inputVector(gold_mgc[min(mgc_index + 2, len(gold_mgc) - 1)])
+                last_mgc = dy.inputVector(gold_mgc[min(mgc_index + self.FRAMES_PER_STEP - 1, len(gold_mgc) - 1)])
 
-            mgc_index += 3
+            mgc_index += self.FRAMES_PER_STEP
             if not runtime and mgc_index >= gold_mgc.shape[0]:
                 break
-        return output_mgc, output_stop, output_att
-
-    def _compute_guided_attention(self, att_vect, decoder_step, num_characters, num_mgcs):
-
-        target_probs = []
-
-        t1 = float(decoder_step) / num_mgcs
-
-        for encoder_step in range(num_characters):
-            target_probs.append(1.0 - np.exp(-((float(encoder_step) / num_characters - t1) ** 2) / 0.1))
-
-        # print target_probs
-        target_probs = dy.inputVector(target_probs)
+            if num_steps == 0:
+                break
 
-        return dy.transpose(target_probs) * att_vect
+    def _compute_guided_attention(self, output_attention, first_step, num_characters, num_mgc):
+        """
+        Guided attention loss of the decoder steps first_step, first_step + 1, ... whose alignments are in
+        output_attention
+        """
+        from models.utils import guided_attention_matrix
+        num_steps = (num_mgc + self.FRAMES_PER_STEP - 1) // self.FRAMES_PER_STEP
+        steps = min(len(output_attention), num_steps - first_step)
+        penalty = guided_attention_matrix(num_characters, num_steps, num_mgc // self.FRAMES_PER_STEP, 0.1)
+        penalty = dy.inputTensor(penalty[:, first_step:first_step + steps])
+        return dy.sum_elems(dy.cmult(penalty, dy.concatenate_cols(output_attention[:steps])))
 
     def _compute_binary_divergence(self, pred, target):
         return dy.binary_log_loss(pred, target)
 
-    def learn(self, characters, target_mgc, guided_att=True):
+    def _compute_losses(self, characters, target_mgc, output_mgc, output_stop, output_attention, guided_att,
+                        first_step=0):
         num_mgc = target_mgc.shape[0]
-        # print num_mgc
-        dy.renew_cg()
-        output_mgc, output_stop, output_attention = self._predict(characters, target_mgc)
         losses = []
-        index = 0
-        for mgc, real_mgc in zip(output_mgc, target_mgc):
+        index = first_step * self.FRAMES_PER_STEP
+        for mgc, real_mgc in zip(output_mgc, target_mgc[index:]):
             t_mgc = dy.inputVector(real_mgc)
             # losses.append(self._compute_binary_divergence(mgc, t_mgc) )
             losses.append(dy.l1_distance(mgc, t_mgc))
 
-            if index % 3 == 0:
-                # attention loss
-                if guided_att:
-                    att = output_attention[index // 3]
-                    losses.append(self._compute_guided_attention(att, index // 3, len(characters) + 2, num_mgc // 3))
+            if index % self.FRAMES_PER_STEP == 0:
+                step = index // self.FRAMES_PER_STEP
                 # EOS loss
-                stop = output_stop[index // 3]
-                if index >= num_mgc - 6:
+                stop = output_stop[step - first_step]
+                if index >= num_mgc - 2 * self.FRAMES_PER_STEP:
                     losses.append(dy.l1_distance(stop, dy.scalarInput(-0.8)))
                 else:
                     losses.append(dy.l1_distance(stop, dy.scalarInput(0.8)))
             index += 1
+        # attention loss, for all steps at once
+        if guided_att:
+            losses.append(self._compute_guided_attention(output_attention, first_step, len(characters) + 2,
+                                                         num_mgc))
+        return losses
+
+    def learn(self, characters, target_mgc, guided_att=True):
+        num_mgc = target_mgc.shape[0]
+        # print num_mgc
+        dy.renew_cg()
+        output_mgc, output_stop, output_attention = self._predict(characters, target_mgc)
+        losses = self._compute_losses(characters, target_mgc, output_mgc, output_stop, output_attention, guided_att)
         loss = dy.esum(losses)
         loss_val = loss.value() / num_mgc
         loss.backward()
         self.trainer.update()
         return loss_val
 
+    def learn_truncated(self, characters, target_mgc, window_steps, guided_att=True):
+        """
+        Truncated backpropagation through time for utterances that are too long for a single graph. The decoder is
+        unrolled for window_steps steps at a time, with one update per window. The decoder state is carried over to
+        the next window as a constant, so memory use depends only on window_steps.
+        """
+        num_mgc = target_mgc.shape[0]
+        num_steps = (num_mgc + self.FRAMES_PER_STEP - 1) // self.FRAMES_PER_STEP
+        total_loss = 0
+        decoder_state = None
+        for first_step in range(0, num_steps, window_steps):
+            dy.renew_cg()
+            output_mgc = []
+            output_stop = []
+            output_attention = []
+            decoder = None
+            for outputs, stop, align, decoder in self._decode_steps(characters, gold_mgc=target_mgc,
+                                                                    first_step=first_step, num_steps=window_steps,
+                                                                    decoder_state=decoder_state):
+                output_mgc.extend(outputs)
+                output_stop.append(stop)
+                output_attention.append(align)
+            losses = self._compute_losses(characters, target_mgc, output_mgc, output_stop, output_attention,
+                                          guided_att, first_step=first_step)
+            loss = dy.esum(losses)
+            total_loss += loss.value()
+            decoder_state = [state.npvalue() for state in decoder.s()]
+            loss.backward()
+            self.trainer.update()
+        return total_loss / num_mgc
+
     def generate(self, characters, max_size=-1):
+        """
+        Returns the generated spectrogram (frames x mgc_order) and the attention matrix (decoder steps x characters)
+        """
         dy.renew_cg()
         output_mgc, ignore1, att = self._predict(characters, max_size=max_size)
-        mgc_output = [mgc.npvalue() for mgc in output_mgc]
-        import numpy as np
-        mgc_final = np.zeros((len(mgc_output), mgc_output[-1].shape[0]))
-        # from ipdb import set_trace
-        # set_trace()
-        for i in range(len(mgc_output)):
-            for j in range(mgc_output[-1].shape[0]):
-                mgc_final[i, j] = mgc_output[i][j]
-        return mgc_final, att
+        mgc_final = np.array([mgc.npvalue() for mgc in output_mgc], dtype=np.float64)
+        return mgc_final, self._attention_matrix(att, len(characters) + 2)
+
+    def generate_stream(self, characters, max_size=-1, block_size=50):
+        """
+        Yields the spectrogram in blocks of (at least) block_size frames while the decoder is still running, so that
+        the vocoder can start on the first block right away. Do not use the encoder for anything else until the
+        generator is exhausted, since both share the DyNet computation graph.
+        """
+        dy.renew_cg()
+        block = []
+        for outputs, _, _, _ in self._decode_steps(characters, max_size=max_size):
+            block.extend([output.npvalue() for output in outputs])
+            if len(block) >= block_size:
+                yield np.array(block)
+                block = []
+        if len(block) != 0:
+            yield np.array(block)
+
+    def _attention_matrix(self, output_att, num_positions):
+        att_final = np.zeros((len(output_att), num_positions))
+        for i, align in enumerate(output_att):
+            if isinstance(align, tuple):
+                # windowed attention: (first position, weights inside the window)
+                start, weights = align
+                att_final[i, start:start + len(weights)] = weights
+            else:
+                att_final[i] = align.npvalue().reshape(-1)
+        return att_final
+
+    def _encode_batch(self, sequences, runtime=False):
+        """
+        Encodes each sequence and returns the encoder matrices, padded with zero columns to the longest sequence and
+        stacked as a minibatch
+        """
+        max_len = max(len(seq) + 2 for seq in sequences)
+        encoder_mats = []
+        for seq in sequences:
+            encoder = self._encode(seq, runtime=runtime)
+            padding = [dy.zeros(encoder[0].dim()[0]) for _ in range(max_len - len(encoder))]
+            encoder_mats.append(dy.concatenate_cols(encoder + padding))
+        return dy.concatenate_to_batch(encoder_mats)
+
+    def _teacher_forced_steps(self, batch, runtime=False):
+        """
+        Teacher-forced decoding of a list of (characters, target_mgc) pairs as a single minibatch. Yields the
+        ([FRAMES_PER_STEP mgc frames], alignment, stop) expressions of each step, for the longest utterance. Padded
+        characters are masked out of the attention.
+        """
+        frames = self.FRAMES_PER_STEP
+        batch_size = len(batch)
+        lengths = [len(characters) + 2 for characters, _ in batch]
+        max_len = max(lengths)
+        num_steps = (max(len(target_mgc) for _, target_mgc in batch) + frames - 1) // frames
+
+        decoder_input = np.zeros((self.params.mgc_order, num_steps, batch_size))
+        att_mask = np.full((max_len, batch_size), -10000.0)
+        for b, (characters, target_mgc) in enumerate(batch):
+            num_mgc = len(target_mgc)
+            steps = (num_mgc + frames - 1) // frames
+            # step t (t > 0) is fed the last gold frame of step t - 1
+            previous = np.minimum(np.arange(1, steps) * frames - 1, num_mgc - 1)
+            decoder_input[:, 1:steps, b] = target_mgc[previous].transpose()
+            att_mask[:lengths[b], b] = 0.0
+        decoder_input = dy.inputTensor(decoder_input, batched=True)
+        att_mask = dy.inputTensor(att_mask, batched=True)
+
+        encoder_mat = self._encode_batch([characters for characters, _ in batch], runtime=runtime)
+        encoder_keys = self.att_w1.expr(update=True) * encoder_mat
+        w2 = self.att_w2.expr(update=True)
+        v = self.att_v.expr(update=True)
+        decoder = self.decoder.initial_state().add_input(
+            dy.lookup_batch(self.decoder_start_lookup, [0] * batch_size))
+        last_mgc = dy.lookup_batch(self.start_lookup, [0] * batch_size)
+
+        for step in range(num_steps):
+            if step != 0:
+                last_mgc = dy.pick(decoder_input, step, 1)
+            scores = v * dy.tanh(dy.colwise_add(encoder_keys, w2 * decoder.s()[-1]))
+            align = dy.softmax(dy.reshape(scores, (max_len,)) + att_mask)
+            att = encoder_mat * align
+
+            mgc_proj = dy.tanh(
+                self.last_mgc_proj_w.expr(update=True) * last_mgc + self.last_mgc_proj_b.expr(update=True))
+            decoder = decoder.add_input(dy.concatenate([mgc_proj, att]))
+            hidden = dy.tanh(self.hid_w.expr(update=True) * decoder.output() + self.hid_b.expr(update=True))
+            highway = self.highway_w.expr(update=True) * att
+            outputs = []
+            for proj_w, proj_b in zip(self.proj_w, self.proj_b):
+                outputs.append(dy.logistic(highway + proj_w.expr(update=True) * hidden + proj_b.expr(update=True)))
+            stop = dy.tanh(self.stop_w.expr(update=True) * decoder.output() + self.stop_b.expr(update=True))
+            yield outputs, align, stop
+
+    def predict_teacher_forced_batch(self, batch):
+        """
+        Ground-truth-aligned (GTA) spectrograms: decodes each (characters, target_mgc) pair with the reference frames
+        as decoder input and returns the predicted spectrograms, each aligned with (and as long as) its target_mgc
+        """
+        dy.renew_cg()
+        output_mgc = []
+        for outputs, _, _ in self._teacher_forced_steps(batch, runtime=True):
+            output_mgc.extend(outputs)
+        # a single forward pass for the whole batch: mgc_order x frames x batch
+        values = dy.concatenate_cols(output_mgc).npvalue().reshape(self.params.mgc_order, len(output_mgc), -1)
+        return [values[:, :len(target_mgc), b].transpose() for b, (_, target_mgc) in enumerate(batch)]
+
+    def learn_batch(self, batch, guided_att=True):
+        """
+        Teacher-forced training on a list of (characters, target_mgc) pairs, with a single update. Utterances are
+        padded to the longest one: padded characters are masked out of the attention and padded frames and steps do
+        not contribute to the loss. Returns the average loss per frame.
+        """
+        from models.utils import guided_attention_matrix
+        dy.renew_cg()
+        frames = self.FRAMES_PER_STEP
+        mgc_order = self.params.mgc_order
+        batch_size = len(batch)
+        lengths = [len(characters) + 2 for characters, _ in batch]
+        num_mgcs = [len(target_mgc) for _, target_mgc in batch]
+        max_len = max(lengths)
+        num_steps = (max(num_mgcs) + frames - 1) // frames
+
+        # gold frames, targets and masks are built in NumPy and passed to DyNet as whole tensors
+        gold = np.zeros((mgc_order, num_steps * frames, batch_size))
+        frame_mask = np.zeros((num_steps * frames, batch_size))
+        step_mask = np.zeros((num_steps, batch_size))
+        stop_target = np.zeros((num_steps, batch_size))
+        guided = np.zeros((max_len, num_steps, batch_size))
+        for b, (characters, target_mgc) in enumerate(batch):
+            num_mgc = num_mgcs[b]
+            steps = (num_mgc + frames - 1) // frames
+            gold[:, :num_mgc, b] = target_mgc.transpose()
+            frame_mask[:num_mgc, b] = 1.0
+            step_mask[:steps, b] = 1.0
+            stop_target[:steps, b] = np.where(np.arange(steps) * frames >= num_mgc - 2 * frames, -0.8, 0.8)
+            if guided_att:
+                guided[:lengths[b], :steps, b] = guided_attention_matrix(lengths[b], steps, num_mgc // frames, 0.1)
+        gold = dy.inputTensor(gold, batched=True)
+        frame_mask = dy.inputTensor(frame_mask, batched=True)
+        step_mask = dy.inputTensor(step_mask, batched=True)
+        stop_target = dy.inputTensor(stop_target, batched=True)
+        guided = dy.inputTensor(guided, batched=True)
+
+        losses = []
+        for step, (outputs, align, stop) in enumerate(self._teacher_forced_steps(batch)):
+            for k, output in enumerate(outputs):
+                index = step * frames + k
+                losses.append(dy.cmult(dy.l1_distance(output, dy.pick(gold, index, 1)), dy.pick(frame_mask, index)))
+
+            # attention loss (zero for padded steps)
+            if guided_att:
+                losses.append(dy.dot_product(dy.pick(guided, step, 1), align))
+            # EOS loss
+            losses.append(dy.cmult(dy.l1_distance(stop, dy.pick(stop_target, step)), dy.pick(step_mask, step)))
+
+        loss = dy.sum_batches(dy.esum(losses))
+        loss_val = loss.value() / sum(num_mgcs)
+        loss.backward()
+        self.trainer.update()
+        return loss_val
+
+    def generate_batch(self, sequences, max_size=-1):
+        """
+        Decodes several utterances in lockstep, as a single DyNet minibatch. Each utterance stops on its own (same
+        rules as generate) and is masked until the whole batch is done. The attention is always computed over the
+        full input (attention_window only applies to single-utterance batches). Returns a list of (mgc, attention)
+        pairs, in input order.
+        """
+        if len(sequences) == 1:
+            return [self.generate(sequences[0], max_size=max_size)]
+        dy.renew_cg()
+        batch_size = len(sequences)
+        lengths = [len(seq) + 2 for seq in sequences]
+        max_len = max(lengths)
+        encoder_mat = self._encode_batch(sequences, runtime=True)
+        encoder_keys = self.att_w1.expr(update=True) * encoder_mat
+        w2 = self.att_w2.expr(update=True)
+        v = self.att_v.expr(update=True)
+        mgc_order = self.params.mgc_order
+        frames = self.FRAMES_PER_STEP
+
+        decoder = self.decoder.initial_state().add_input(
+            dy.lookup_batch(self.decoder_start_lookup, [0] * batch_size))
+        last_mgc = dy.lookup_batch(self.start_lookup, [0] * batch_size)
+
+        output_mgc = [[] for _ in range(batch_size)]
+        output_att = [[] for _ in range(batch_size)]
+        done = [False] * batch_size
+        mgc_index = [0] * batch_size
+        last_att_pos = [0] * batch_size
+        stationed_count = [0] * batch_size
+        first = [4] * batch_size
+        from models.utils import AlignmentMonitor
+        monitors = [AlignmentMonitor(len(seq), frames) for seq in sequences]
+        attended = [0] * batch_size  # raw attention argmax, before forcing it to be monotonic
+        while True:
+            scores = v * dy.tanh(dy.colwise_add(encoder_keys, w2 * decoder.s()[-1]))
+            scores = dy.reshape(scores, (max_len,)).npvalue().reshape(max_len, -1)
+            weights = np.zeros((max_len, batch_size))
+            for b in range(batch_size):
+                if done[b]:
+                    continue
+                align = np.exp(scores[:lengths[b], b] - scores[:lengths[b], b].max())
+                align /= align.sum()
+                # force incremental attention
+                current_pos = int(np.argmax(align))
+                attended[b] = current_pos
+                if current_pos < last_att_pos[b] or current_pos >= last_att_pos[b] + 2:
+                    current_pos = min(last_att_pos[b] + 1, lengths[b] - 1)
+                    align = np.zeros(lengths[b])
+                    align[current_pos] = 1.0
+                last_att_pos[b] = current_pos
+                if first[b] > 0:
+                    last_att_pos[b] = 0
+                    first[b] -= 1
+
+                if last_att_pos[b] == len(sequences[b]) - 1:
+                    stationed_count[b] += 1
+                    if stationed_count[b] > 5:
+                        done[b] = True
+                        continue
+                weights[:lengths[b], b] = align
+                output_att[b].append(align)
+            if all(done):
+                break
+
+            att = encoder_mat * dy.inputTensor(weights, batched=True)
+            mgc_proj = dy.tanh(
+                self.last_mgc_proj_w.expr(update=True) * last_mgc + self.last_mgc_proj_b.expr(update=True))
+            decoder = decoder.add_input(dy.concatenate([mgc_proj, att]))
+            hidden = dy.tanh(self.hid_w.expr(update=True) * decoder.output() + self.hid_b.expr(update=True))
+            highway = self.highway_w.expr(update=True) * att
+            outputs = []
+            for proj_w, proj_b in zip(self.proj_w, self.proj_b):
+                outputs.append(dy.logistic(highway + proj_w.expr(update=True) * hidden + proj_b.expr(update=True)))
+            outputs.append(dy.tanh(self.stop_w.expr(update=True) * decoder.output() + self.stop_b.expr(update=True)))
+            # a single forward pass and host transfer per step for the whole batch
+            values = dy.concatenate(outputs).npvalue().reshape(frames * mgc_order + 1, -1)
+
+            for b in range(batch_size):
+                if done[b]:
+                    continue
+                output_mgc[b].append(values[:frames * mgc_order, b].reshape(frames, mgc_order))
+                if max_size != -1 and mgc_index[b] > max_size:
+                    done[b] = True
+                elif max_size == -1 and values[-1, b] < -0.5:
+                    done[b] = True
+                elif monitors[b].update(last_att_pos[b], values[-1, b], attended[b]) is not None:
+                    done[b] = True
+                elif mgc_index[b] >= len(sequences[b]) * 7:  # safeguard
+                    done[b] = True
+                mgc_index[b] += frames
+            if all(done):
+                break
+            last_mgc = dy.inputTensor(values[(frames - 1) * mgc_order:frames * mgc_order], batched=True)
+
+        results = []
+        for b in range(batch_size):
+            if len(output_mgc[b]) == 0:
+                results.append((np.zeros((0, mgc_order)), np.zeros((0, lengths[b]))))
+            else:
+                results.append((np.concatenate(output_mgc[b]), np.array(output_att[b])))
+        return results
 
     def store(self, output_base):
         self.model.save(output_base + ".network")
+        with open(output_base + ".conf", 'w') as f:
+            f.write('frames_per_step\t' + str(self.FRAMES_PER_STEP) + '\n')
 
     def load(self, output_base):
         self.model.populate(output_base + ".network")
 
-    def _attend(self, input_list, decoder_state, last_pos=None):
-        w1 = self.att_w1.expr(update=True)
+    def snapshot(self):
+        """
+        In-memory copy of all parameters (see restore)
+        """
+        from models.utils import get_parameter_values
+        return get_parameter_values(self.model)
+
+    def restore(self, snapshot):
+        from models.utils import set_parameter_values
+        set_parameter_values(self.model, snapshot)
+
+    def export(self, output_base):
+        """
+        Writes all weights to <output_base>.npz, for the NumPy runtime in models/encoder_numpy.py
+        """
+        weights = {}
+        for name in ['phone_lookup', 'feature_lookup', 'speaker_lookup', 'hid_w', 'hid_b', 'highway_w',
+                     'last_mgc_proj_w', 'last_mgc_proj_b', 'stop_w', 'stop_b', 'att_w1', 'att_w2', 'att_v',
+                     'start_lookup', 'decoder_start_lookup']:
+            weights[name] = getattr(self, name).as_array()
+        for k, (proj_w, proj_b) in enumerate(zip(self.proj_w, self.proj_b)):
+            weights['proj_w_' + str(k + 1)] = proj_w.as_array()
+            weights['proj_b_' + str(k + 1)] = proj_b.as_array()
+        lstms = [('encoder_fw.' + str(i), lstm) for i, lstm in enumerate(self.encoder_fw)]
+        lstms += [('encoder_bw.' + str(i), lstm) for i, lstm in enumerate(self.encoder_bw)]
+        lstms.append(('decoder', self.decoder))
+        for prefix, lstm in lstms:
+            # DyNet VanillaLSTM parameters, with gates stacked in i, f, o, g order
+            for layer, (w_x, w_h, b) in enumerate(lstm.get_parameters()):
+                weights[prefix + '.' + str(layer) + '.Wx'] = w_x.as_array()
+                weights[prefix + '.' + str(layer) + '.Wh'] = w_h.as_array()
+                weights[prefix + '.' + str(layer) + '.b'] = b.as_array()
+        np.savez(output_base + '.npz', **weights)
+
+    def _make_attention_keys(self, input_list):
+        """
+        Returns the encoder states as a matrix (one column per character) and their projection through att_w1
+        """
+        input_mat = dy.concatenate_cols(input_list)
+        return input_mat, self.att_w1.expr(update=True) * input_mat
+
+    def _attend(self, input_list, input_mat, input_keys, decoder_state, last_pos=None):
         w2 = self.att_w2.expr(update=True)
         v = self.att_v.expr(update=True)
-        attention_weights = []
 
         w2dt = w2 * dy.concatenate([decoder_state.s()[-1]])
-        for input_vector in input_list:
-            attention_weight = v * dy.tanh(w1 * input_vector + w2dt)
-            attention_weights.append(attention_weight)
-
-        attention_weights = dy.softmax(dy.concatenate(attention_weights))
+        attention_weights = v * dy.tanh(dy.colwise_add(input_keys, w2dt))
+        attention_weights = dy.softmax(dy.reshape(attention_weights, (len(input_list),)))
         # force incremental attention if this is runtime
+        attended = None
         if last_pos is not None:
             current_pos = np.argmax(attention_weights.value())
+            attended = current_pos
             if current_pos < last_pos or current_pos >= last_pos + 2:
                 current_pos = last_pos + 1
                 if current_pos >= len(input_list):
@@ -296,9 +689,35 @@ class Encoder:
                 simulated_att = np.zeros((len(input_list)))
                 simulated_att[current_pos] = 1.0
                 new_att_vec = dy.inputVector(simulated_att)
-                return output_vectors, new_att_vec
+                return output_vectors, new_att_vec, attended
 
-        output_vectors = dy.esum(
-            [vector * attention_weight for vector, attention_weight in zip(input_list, attention_weights)])
+        output_vectors = input_mat * attention_weights
 
-        return output_vectors, attention_weights
+        return output_vectors, attention_weights, attended
+
+    def _attend_window(self, input_list, input_mat, input_keys, decoder_state, last_pos):
+        """
+        Runtime-only attention that scores the characters inside [last_pos - window, last_pos + window]. Because the
+        attention is forced to move by at most one position per step, the characters outside the window only matter
+        through the softmax normalization. Returns the context vector, the (start, weights) alignment and the new
+        position, followed by the raw attention argmax (before forcing it to be monotonic).
+        """
+        start = max(last_pos - self.attention_window, 0)
+        stop = min(last_pos + self.attention_window + 1, len(input_list))
+        w2 = self.att_w2.expr(update=True)
+        v = self.att_v.expr(update=True)
+
+        w2dt = w2 * dy.concatenate([decoder_state.s()[-1]])
+        window_keys = dy.select_cols(input_keys, list(range(start, stop)))
+        attention_weights = v * dy.tanh(dy.colwise_add(window_keys, w2dt))
+        attention_weights = dy.softmax(dy.reshape(attention_weights, (stop - start,)))
+        weights = attention_weights.npvalue().reshape(-1)
+
+        current_pos = start + int(np.argmax(weights))
+        attended = current_pos
+        if current_pos < last_pos or current_pos >= last_pos + 2:
+            current_pos = min(last_pos + 1, len(input_list) - 1)
+            return input_list[current_pos], (current_pos, np.ones(1)), current_pos, attended
+
+        output_vectors = dy.select_cols(input_mat, list(range(start, stop))) * attention_weights
+        return output_vectors, (start, weights), current_pos, attended
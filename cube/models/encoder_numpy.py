@@ -0,0 +1,425 @@
+#
+# Author: Tiberiu Boros
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import numpy as np
+
+# dy.VanillaLSTMBuilder adds this to the forget gate pre-activation
+FORGET_BIAS = 1.0
+
+
+def _sigmoid(x, out):
+    np.multiply(x, 0.5, out=out)
+    np.tanh(out, out=out)
+    out += 1.0
+    out *= 0.5
+    return out
+
+
+class _Dense:
+    def __init__(self, matrix):
+        self.matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        self.shape = self.matrix.shape
+
+    def dot(self, x, out):
+        return np.dot(self.matrix, x, out=out)
+
+
+class _LowRank:
+    """
+    Weight matrix factorized as u * v (see scripts/compress_encoder.py)
+    """
+
+    def __init__(self, u, v):
+        self.u = np.ascontiguousarray(u, dtype=np.float32)
+        self.v = np.ascontiguousarray(v, dtype=np.float32)
+        self.shape = (self.u.shape[0], self.v.shape[1])
+        self.tmp = np.zeros(self.v.shape[0], dtype=np.float32)
+
+    def dot(self, x, out):
+        np.dot(self.v, x, out=self.tmp)
+        return np.dot(self.u, self.tmp, out=out)
+
+
+class _Int8:
+    """
+    Weight matrix kept as int8 rows with one scale per row (see scripts/compress_encoder.py). NumPy has no int8 matrix
+    products, so each product converts blocks of rows into a small float32 buffer that stays in the CPU cache: the
+    weights take a quarter of the memory, but the number of multiplications is the same as for the dense matrix.
+    """
+
+    BLOCK_BYTES = 256 * 1024
+
+    def __init__(self, q, scale):
+        self.q = np.ascontiguousarray(q, dtype=np.int8)
+        self.scale = np.ascontiguousarray(scale, dtype=np.float32).reshape(-1)
+        self.shape = self.q.shape
+        self.block_rows = max(self.BLOCK_BYTES // (4 * self.shape[1]), 1)
+        self.block = np.zeros((min(self.block_rows, self.shape[0]), self.shape[1]), dtype=np.float32)
+
+    def dot(self, x, out):
+        for start in range(0, self.shape[0], self.block_rows):
+            stop = min(start + self.block_rows, self.shape[0])
+            block = self.block[:stop - start]
+            np.copyto(block, self.q[start:stop], casting='unsafe')
+            np.dot(block, x, out=out[start:stop])
+        out *= self.scale
+        return out
+
+
+def load_linear(weights, name):
+    """
+    Returns the matrix stored under name, as written by Encoder.export (dense), or by scripts/compress_encoder.py
+    (name.u/name.v low-rank factors or name.q/name.scale int8 rows with one scale per row)
+    """
+    if name + '.u' in weights:
+        return _LowRank(weights[name + '.u'], weights[name + '.v'])
+    if name + '.q' in weights:
+        return _Int8(weights[name + '.q'], weights[name + '.scale'])
+    return _Dense(weights[name])
+
+
+class _LSTMLayer:
+    """
+    Single DyNet VanillaLSTM layer. The input and recurrent weights are merged, so that a step is a single
+    matrix-vector product over the [input; previous output] buffer.
+    """
+
+    def __init__(self, w, b, input_size):
+        self.input_size = input_size
+        self.hidden_size = b.shape[0] // 4
+        self.w = w
+        self.b = b.copy()
+        self.b[self.hidden_size:2 * self.hidden_size] += FORGET_BIAS
+        self.gates = np.zeros(4 * self.hidden_size, dtype=np.float32)
+        self.tmp = np.zeros(self.hidden_size, dtype=np.float32)
+
+    def step(self, gates, c, h):
+        """
+        Applies the gate non-linearities to precomputed pre-activations and updates c and h in-place
+        """
+        size = self.hidden_size
+        _sigmoid(gates[:3 * size], gates[:3 * size])
+        np.tanh(gates[3 * size:], out=gates[3 * size:])
+        c *= gates[size:2 * size]
+        np.multiply(gates[:size], gates[3 * size:], out=self.tmp)
+        c += self.tmp
+        np.tanh(c, out=h)
+        h *= gates[2 * size:3 * size]
+
+    def transduce(self, x_seq):
+        # the input projection is computed for the whole sequence at once (dense weights only)
+        w_x = self.w.matrix[:, :self.input_size]
+        w_h = np.ascontiguousarray(self.w.matrix[:, self.input_size:])
+        x_proj = np.dot(x_seq, w_x.T) + self.b
+        output = np.zeros((len(x_seq), self.hidden_size), dtype=np.float32)
+        c = np.zeros(self.hidden_size, dtype=np.float32)
+        h = np.zeros(self.hidden_size, dtype=np.float32)
+        for t in range(len(x_seq)):
+            np.dot(w_h, h, out=self.gates)
+            self.gates += x_proj[t]
+            self.step(self.gates, c, h)
+            output[t] = h
+        return output
+
+
+def _load_lstm(weights, prefix):
+    if prefix + 'Wx' in weights:
+        w = _Dense(np.concatenate([weights[prefix + 'Wx'], weights[prefix + 'Wh']], axis=1))
+    else:
+        w = load_linear(weights, prefix + 'W')
+    b = weights[prefix + 'b']
+    return _LSTMLayer(w, b, w.shape[1] - b.shape[0] // 4)
+
+
+class _DecoderState:
+    """
+    Preallocated state of the stacked decoder LSTM. Each layer has an [input; output] buffer; the input part of the
+    first layer is written by the caller.
+    """
+
+    def __init__(self, layers):
+        self.layers = layers
+        self.xh = [np.zeros(layer.input_size + layer.hidden_size, dtype=np.float32) for layer in layers]
+        self.c = [np.zeros(layer.hidden_size, dtype=np.float32) for layer in layers]
+        self.input = self.xh[0][:layers[0].input_size]
+
+    def output(self):
+        return self.xh[-1][self.layers[-1].input_size:]
+
+    def add_input(self):
+        for index, layer in enumerate(self.layers):
+            xh = self.xh[index]
+            layer.w.dot(xh, layer.gates)
+            layer.gates += layer.b
+            h = xh[layer.input_size:]
+            layer.step(layer.gates, self.c[index], h)
+            if index + 1 < len(self.layers):
+                self.xh[index + 1][:layer.hidden_size] = h
+
+
+class NumpyEncoder:
+    """
+    NumPy-only runtime for models.encoder.Encoder. It loads the weights written by Encoder.export and follows the
+    same decoding rules as Encoder.generate (forced monotonic attention, stop token and length safeguards), without
+    building a computation graph for every step.
+    """
+
+    def __init__(self, params, encodings):
+        self.params = params
+        self.encodings = encodings
+        self.attention_window = 0
+        # optional models.utils.LRUCache of BiLSTM outputs (they do not depend on the speaker)
+        self.encoder_cache = None
+        self.weights = None
+
+    def load(self, output_base):
+        data = np.load(output_base + '.npz')
+        # int8 weights (name.q) stay int8 in memory, everything else is float32
+        self.weights = {name: np.ascontiguousarray(data[name], dtype=np.int8 if name.endswith('.q') else np.float32)
+                        for name in data.files}
+        w = self.weights
+        self.encoder_fw = []
+        self.encoder_bw = []
+        index = 0
+        while 'encoder_fw.' + str(index) + '.0.b' in w:
+            self.encoder_fw.append(_load_lstm(w, 'encoder_fw.' + str(index) + '.0.'))
+            self.encoder_bw.append(_load_lstm(w, 'encoder_bw.' + str(index) + '.0.'))
+            index += 1
+        self.decoder = []
+        index = 0
+        while 'decoder.' + str(index) + '.b' in w:
+            self.decoder.append(_load_lstm(w, 'decoder.' + str(index) + '.'))
+            index += 1
+        self.hid_w = load_linear(w, 'hid_w')
+        # one output projection per frame emitted by a decoder step
+        self.frames_per_step = 0
+        while 'proj_b_' + str(self.frames_per_step + 1) in w:
+            self.frames_per_step += 1
+        self.proj_w = [load_linear(w, 'proj_w_' + str(k + 1)) for k in range(self.frames_per_step)]
+        self.proj_b = [w['proj_b_' + str(k + 1)] for k in range(self.frames_per_step)]
+        self.att_v = w['att_v'].reshape(-1)
+        self.stop_w = w['stop_w'].reshape(-1)
+        self.stop_b = float(w['stop_b'].reshape(-1)[0])
+
+    def _make_input(self, seq):
+        phone_lookup = self.weights['phone_lookup']
+        feature_lookup = self.weights['feature_lookup']
+        x_input = np.zeros((len(seq) + 2, phone_lookup.shape[1]), dtype=np.float32)
+        x_input[0] = phone_lookup[self.encodings.char2int['START']]
+        for index, pi in enumerate(seq):
+            x_input[index + 1] = phone_lookup[self.encodings.char2int[pi.char]]
+            context = [self.encodings.context2int[feature] for feature in pi.context if
+                       feature in self.encodings.context2int]
+            if len(context) != 0:
+                x_input[index + 1] += feature_lookup[context].sum(axis=0) * (1.0 / len(context))
+        x_input[-1] = phone_lookup[self.encodings.char2int['STOP']]
+        return x_input
+
+    def _get_speaker_embedding(self, seq):
+        for entry in seq:
+            for feature in entry.context:
+                if feature.startswith('SPEAKER:'):
+                    return self.weights['speaker_lookup'][self.encodings.speaker2int[feature]]
+        return None
+
+    def _encode(self, characters):
+        cache_key = None
+        x_input = None
+        if self.encoder_cache is not None:
+            from models.utils import encoder_input_key
+            cache_key = encoder_input_key(characters, self.encodings)
+            x_input = self.encoder_cache.get(cache_key)
+
+        if x_input is None:
+            x_input = self._make_input(characters)
+            for lstm_fw, lstm_bw in zip(self.encoder_fw, self.encoder_bw):
+                x_fw = lstm_fw.transduce(x_input)
+                x_bw = lstm_bw.transduce(x_input[::-1])[::-1]
+                x_input = np.concatenate([x_fw, x_bw], axis=1)
+            if cache_key is not None:
+                self.encoder_cache.put(cache_key, x_input)
+        x_speaker = self._get_speaker_embedding(characters)
+        return np.ascontiguousarray(
+            np.concatenate([x_input, np.tile(x_speaker, (len(x_input), 1))], axis=1), dtype=np.float32)
+
+    def _attend(self, encoder, keys, scratch, query, last_pos):
+        """
+        Returns the first scored position, the attention weights, the new position and the raw attention argmax.
+        Unless last_pos is None (teacher forcing), the new position is forced to be monotonic.
+        """
+        start = 0
+        stop = len(encoder)
+        if self.attention_window > 0 and last_pos is not None:
+            start = max(last_pos - self.attention_window, 0)
+            stop = min(last_pos + self.attention_window + 1, len(encoder))
+        scratch = scratch[:stop - start]
+        np.add(keys[start:stop], query, out=scratch)
+        np.tanh(scratch, out=scratch)
+        scores = np.dot(scratch, self.att_v)
+        scores -= scores.max()
+        np.exp(scores, out=scores)
+        scores /= scores.sum()
+
+        current_pos = start + int(np.argmax(scores))
+        attended = current_pos
+        if last_pos is not None and (current_pos < last_pos or current_pos >= last_pos + 2):
+            current_pos = min(last_pos + 1, len(encoder) - 1)
+            return current_pos, None, current_pos, attended
+        return start, scores, current_pos, attended
+
+    def generate(self, characters, max_size=-1):
+        """
+        Returns the generated spectrogram (frames x mgc_order) and the attention matrix (decoder steps x characters)
+        """
+        output_mgc, output_att, steps = None, None, 0
+        for output_mgc, output_att, steps in self._decode_steps(characters, max_size=max_size):
+            pass
+        if output_mgc is None:
+            return np.zeros((0, self.proj_b[0].shape[0]), dtype=np.float32), np.zeros((0, len(characters) + 2))
+        return output_mgc[:steps * self.frames_per_step], output_att[:steps]
+
+    def generate_stream(self, characters, max_size=-1, block_size=50):
+        """
+        Yields the spectrogram in blocks of (at least) block_size frames while the decoder is still running
+        """
+        output_mgc, steps, emitted = None, 0, 0
+        for output_mgc, _, steps in self._decode_steps(characters, max_size=max_size):
+            if steps * self.frames_per_step - emitted >= block_size:
+                yield output_mgc[emitted:steps * self.frames_per_step].copy()
+                emitted = steps * self.frames_per_step
+        if steps * self.frames_per_step > emitted:
+            yield output_mgc[emitted:steps * self.frames_per_step].copy()
+
+    def predict_teacher_forced(self, characters, gold_mgc):
+        """
+        Decodes with the reference frames as decoder input, like Encoder.learn does, and returns the spectrogram.
+        The output is aligned with gold_mgc, so it can be used to measure the accuracy of (compressed) weights.
+        """
+        output_mgc, steps = None, 0
+        for output_mgc, _, steps in self._decode_steps(characters, gold_mgc=gold_mgc):
+            pass
+        return output_mgc[:min(steps * self.frames_per_step, len(gold_mgc))]
+
+    def _decode_steps(self, characters, max_size=-1, gold_mgc=None):
+        """
+        Runs the decoder and, after each step, yields the (preallocated) spectrogram and attention buffers together
+        with the number of steps written to them so far
+        """
+        w = self.weights
+        encoder = self._encode(characters)
+        keys = np.dot(encoder, w['att_w1'].T)
+        scratch = np.zeros_like(keys)
+        num_positions = len(encoder)
+
+        frames = self.frames_per_step
+        runtime = gold_mgc is None
+        if runtime:
+            max_steps = len(characters) * 7 // frames + 2
+            if max_size != -1:
+                max_steps = min(max_steps, max_size // frames + 2)
+        else:
+            gold_mgc = np.asarray(gold_mgc, dtype=np.float32)
+            max_steps = (len(gold_mgc) + frames - 1) // frames
+        mgc_order = self.proj_b[0].shape[0]
+        output_mgc = np.zeros((max_steps * frames, mgc_order), dtype=np.float32)
+        output_att = np.zeros((max_steps, num_positions), dtype=np.float32)
+
+        decoder = _DecoderState(self.decoder)
+        decoder.input[:] = w['decoder_start_lookup'][0]
+        decoder.add_input()
+        mgc_proj_size = w['last_mgc_proj_b'].shape[0]
+        mgc_proj = decoder.input[:mgc_proj_size]
+        att = decoder.input[mgc_proj_size:]
+        last_mgc = w['start_lookup'][0]
+        hidden = np.zeros(w['hid_b'].shape[0], dtype=np.float32)
+        highway = np.zeros(mgc_order, dtype=np.float32)
+
+        mgc_index = 0
+        step = 0
+        last_att_pos = 0 if runtime else None
+        monitor = None
+        if runtime:
+            from models.utils import AlignmentMonitor
+            monitor = AlignmentMonitor(len(characters), frames, self.attention_window)
+        stationed_count = 0
+        first = 4
+        while True:
+            query = np.dot(w['att_w2'], decoder.output())
+            start, weights, current_pos, attended = self._attend(encoder, keys, scratch, query, last_att_pos)
+            if runtime:
+                last_att_pos = current_pos
+            if runtime and first > 0:
+                last_att_pos = 0
+                first -= 1
+
+            if runtime and last_att_pos == len(characters) - 1:
+                stationed_count += 1
+                if stationed_count > 5:
+                    break
+
+            if weights is None:
+                output_att[step, start] = 1.0
+                att[:] = encoder[start]
+            else:
+                output_att[step, start:start + len(weights)] = weights
+                np.dot(weights, encoder[start:start + len(weights)], out=att)
+
+            # main output
+            np.dot(w['last_mgc_proj_w'], last_mgc, out=mgc_proj)
+            mgc_proj += w['last_mgc_proj_b']
+            np.tanh(mgc_proj, out=mgc_proj)
+            decoder.add_input()
+            self.hid_w.dot(decoder.output(), hidden)
+            hidden += w['hid_b']
+            np.tanh(hidden, out=hidden)
+
+            np.dot(w['highway_w'], att, out=highway)
+            for k in range(frames):
+                output = output_mgc[step * frames + k]
+                self.proj_w[k].dot(hidden, output)
+                output += highway
+                output += self.proj_b[k]
+                _sigmoid(output, output)
+            stop = np.tanh(np.dot(self.stop_w, decoder.output()) + self.stop_b)
+            step += 1
+            yield output_mgc, output_att, step
+
+            if not runtime:
+                last_mgc = gold_mgc[min(mgc_index + frames - 1, len(gold_mgc) - 1)]
+                mgc_index += frames
+                if mgc_index >= len(gold_mgc):
+                    break
+                continue
+
+            if max_size != -1 and mgc_index > max_size:
+                break
+            last_mgc = output_mgc[step * frames - 1]
+            if max_size == -1 and stop < -0.5:
+                break
+            if monitor.update(last_att_pos, float(stop), attended) is not None:
+                break
+
+            if mgc_index >= len(characters) * 7:  # safeguard
+                break
+
+            mgc_index += frames
+
+    def generate_batch(self, sequences, max_size=-1):
+        """
+        Same interface as Encoder.generate_batch. Utterances are decoded one after the other, since this runtime
+        has no per-step graph overhead to amortize.
+        """
+        return [self.generate(seq, max_size=max_size) for seq in sequences]
@@ -91,22 +91,15 @@ class G2P:
 
         return emb_list
 
-    def _compute_guided_attention(self, att_vect, decoder_step, input_size, output_size):
-        if output_size <= 1 or input_size <= 1:
+    def _compute_guided_attention(self, att_list, input_size, output_size):
+        """
+        Guided attention loss of all decoder steps, as a single expression
+        """
+        if output_size <= 1 or input_size <= 1 or len(att_list) == 0:
             return dy.scalarInput(0)
-
-        target_probs = []
-
-        t1 = float(decoder_step) / output_size
-
-        for encoder_step in range(input_size):
-            target_probs.append(1.0 - np.exp(-((float(encoder_step) / input_size - t1) ** 2) / 0.08))
-
-        # print target_probs
-        target_probs = dy.inputVector(target_probs)
-        # print (target_probs.npvalue().shape, att_vect.npvalue().shape)
-
-        return dy.transpose(target_probs) * att_vect
+        from models.utils import guided_attention_matrix
+        penalty = dy.inputTensor(guided_attention_matrix(input_size, len(att_list), output_size, 0.08))
+        return dy.sum_elems(dy.cmult(penalty, dy.concatenate_cols(att_list)))
 
     def _compute_binary_divergence(self, pred, target):
         return dy.binary_log_loss(pred, target)
@@ -195,9 +188,10 @@ class G2P:
     def learn(self, word, transcription):
         output_list, att_list = self._predict(word, gs_phones=transcription)
 
-        for tp, pp, att, pos in zip(transcription, output_list, att_list, range(len(att_list))):
+        for tp, pp in zip(transcription, output_list):
             self.losses.append(dy.pickneglogsoftmax(pp, self.encodings.phoneme2int[tp]))
-            self.losses.append(self._compute_guided_attention(att, pos, len(word), len(transcription) + 1))
+        num_steps = min(len(transcription), len(att_list))
+        self.losses.append(self._compute_guided_attention(att_list[:num_steps], len(word), len(transcription) + 1))
 
         self.losses.append(dy.pickneglogsoftmax(output_list[-1], len(self.encodings.phoneme2int)))
 
@@ -14,11 +14,166 @@
 # limitations under the License.
 #
 
-import dynet as dy
+from collections import OrderedDict
+from functools import lru_cache
+
 import numpy as np
 
 
+class LRUCache:
+    """
+    Dictionary with a fixed number of entries. When it is full, the least recently used entry is evicted.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class AlignmentMonitor:
+    """
+    Online health check of the attention while decoding at runtime. update() is called after every decoder step
+    with the position used by the decoder (after the forced-monotonic rule), the stop token value and the raw
+    argmax of the attention (before that rule is applied). It returns the reason for ending a runaway decode early -
+    'stall' (stuck on the same character), 'jump' (the raw attention stayed far ahead of or behind the decoder
+    position for JUMP_FRAMES frames in a row) or 'stop' (the text is finished but the stop token is not going down) -
+    or None while the alignment looks healthy. Single-step attention outliers are clamped by the forced-monotonic
+    rule anyway, so they are only counted. Every decode and every event is counted in profiling.metrics.
+
+    With attention_window > 0 the raw argmax never leaves the window, so a deviation is the argmax sitting on the
+    edge of the window instead. With attention_window = 1 jumps cannot be detected.
+    """
+
+    STALL_FRAMES = 150
+    JUMP_FRAMES = 15
+    MAX_JUMP_FORWARD = 8
+    MAX_JUMP_BACKWARD = 3
+    STOP_WINDOW = 20  # decoder steps after reaching the end of the text
+
+    def __init__(self, num_characters, frames_per_step, attention_window=0):
+        from profiling import metrics
+        self.num_characters = num_characters
+        self.frames_per_step = frames_per_step
+        self.max_forward = self.MAX_JUMP_FORWARD
+        self.max_backward = self.MAX_JUMP_BACKWARD
+        if attention_window > 0:
+            # a normal step moves forward by one character, which must not count as a deviation
+            self.max_forward = max(min(self.MAX_JUMP_FORWARD, attention_window - 1), 1)
+            self.max_backward = max(min(self.MAX_JUMP_BACKWARD, attention_window - 1), 1)
+        self.position = None
+        self.stationed_frames = 0
+        self.jump_frames = 0
+        self.end_stops = []
+        metrics.increment('encoder.decodes')
+
+    def update(self, position, stop, attended):
+        from profiling import metrics
+        event = None
+        if self.position is not None:
+            # the forced position moves by at most one character, so jumps are only visible in the raw attention
+            if attended - self.position > self.max_forward or self.position - attended > self.max_backward:
+                metrics.increment('encoder.attention_outliers')
+                self.jump_frames += self.frames_per_step
+                if self.jump_frames >= self.JUMP_FRAMES:
+                    event = 'jump'
+            else:
+                self.jump_frames = 0
+            if position == self.position:
+                self.stationed_frames += self.frames_per_step
+                if self.stationed_frames > self.STALL_FRAMES:
+                    event = 'stall'
+            else:
+                self.stationed_frames = 0
+        self.position = position
+
+        if event is None and position >= self.num_characters - 1:
+            self.end_stops.append(stop)
+            if len(self.end_stops) >= self.STOP_WINDOW:
+                window = self.end_stops[-self.STOP_WINDOW:]
+                if np.mean(window[-5:]) >= np.mean(window[:5]):
+                    event = 'stop'
+
+        if event is not None:
+            import sys
+            metrics.increment('encoder.runaway.' + event)
+            sys.stderr.write('Runaway decode (' + event + ' at character ' + str(position) + '/' + str(
+                self.num_characters) + '), stopping early\n')
+        return event
+
+
+def encoder_input_key(seq, encodings):
+    """
+    Key of the speaker-independent part of an encoder input: the characters together with the (known) context
+    features they are embedded with. SPEAKER features are never in context2int, so they are not part of the key.
+    """
+    return tuple((pi.char, tuple(sorted(feature for feature in pi.context if feature in encodings.context2int)))
+                 for pi in seq)
+
+
+@lru_cache(maxsize=16)
+def guided_attention_matrix(num_inputs, num_steps, step_norm, width):
+    """
+    Penalty matrix (num_inputs x num_steps) of the guided attention loss: 1 - exp(-(n / num_inputs - t / step_norm)^2
+    / width) for input n and decoder step t. It is small near the diagonal. Encoder utterances rarely share a shape,
+    so only the last few matrices are kept: the ones reused by the windows of Encoder.learn_truncated and the short,
+    repeating shapes of G2P. Cached matrices are shared, so they are read-only.
+    """
+    n = np.arange(num_inputs, dtype=np.float32).reshape(-1, 1) / num_inputs
+    t = np.arange(num_steps, dtype=np.float32).reshape(1, -1) / step_norm
+    penalty = 1.0 - np.exp(-((n - t) ** 2) / width)
+    penalty = penalty.astype(np.float32)
+    penalty.flags.writeable = False
+    return penalty
+
+
+def get_parameter_values(model):
+    """
+    Values of all parameters and lookup parameters of a DyNet model, as a single float32 vector
+    """
+    values = [param.as_array().reshape(-1) for param in model.parameters_list()]
+    values += [param.as_array().reshape(-1) for param in model.lookup_parameters_list()]
+    return np.concatenate(values).astype(np.float32)
+
+
+def set_parameter_values(model, values):
+    """
+    Inverse of get_parameter_values
+    """
+    offset = 0
+    for param in model.parameters_list():
+        shape = param.as_array().shape
+        size = int(np.prod(shape))
+        param.set_value(values[offset:offset + size].reshape(shape))
+        offset += size
+    for param in model.lookup_parameters_list():
+        shape = param.as_array().shape
+        size = int(np.prod(shape))
+        param.init_from_array(values[offset:offset + size].reshape(shape))
+        offset += size
+
+
 def orthonormal_VanillaLSTMBuilder(lstm_layers, input_dims, lstm_hiddens, pc):
+    import dynet as dy
     builder = dy.VanillaLSTMBuilder(lstm_layers, input_dims, lstm_hiddens, pc)
     for layer, params in enumerate(builder.get_parameters()):
         W = orthonormal_initializer(lstm_hiddens, lstm_hiddens + (lstm_hiddens if layer > 0 else input_dims))
@@ -125,6 +125,16 @@ class Vocoder:
         self.model.load_state_dict(torch.load(output_base + ".network", map_location=device))
         self.model.to(device)
 
+    def snapshot(self):
+        """
+        In-memory copy of the trained weights (see restore)
+        """
+        return {name: value.detach().cpu().clone() for name, value in self.model.state_dict().items()}
+
+    def restore(self, snapshot):
+        self.model.load_state_dict(snapshot)
+        self.model.to(device)
+
 
 class ParallelVocoder:
     def __init__(self, params, vocoder=None):
@@ -188,7 +198,12 @@ class ParallelVocoder:
 
         return total_loss / len(x_list)
 
-    def synthesize(self, mgc, batch_size, temperature=1.0):
+    def synthesize(self, mgc, batch_size, temperature=1.0, chunk_size=-1):
+        if chunk_size > 0:
+            chunks = list(self.synthesize_stream([mgc], temperature=temperature, chunk_size=chunk_size))
+            if len(chunks) == 0:
+                return np.zeros((0))
+            return np.concatenate(chunks)
         num_samples = len(mgc) * self.UPSAMPLE_COUNT
         zeros = np.zeros((1, 1, num_samples))
         ones = np.ones((1, 1, num_samples))
@@ -203,9 +218,73 @@ class ParallelVocoder:
         x = x.squeeze().cpu().numpy() * 32768
         return x
 
+    def _receptive_frames(self):
+        # number of mel frames of left context needed to cover the receptive field of all IAF flows
+        samples = 0
+        for flow in self.model_s.iafs:
+            samples += flow.front_channels
+            for block in flow.res_blocks:
+                samples += (flow.kernel_size - 1) * block.filter_conv.conv.dilation[0]
+        return samples // self.UPSAMPLE_COUNT + 2
+
+    def synthesize_stream(self, mgc_blocks, temperature=1.0, chunk_size=100):
+        """
+        Vocodes an iterable of mel blocks in chunks of chunk_size frames and yields the signal of each chunk as soon
+        as it is available. Each chunk is computed with enough left context (frames and the same noise samples) to
+        cover the receptive field of the student, so chunks join seamlessly.
+        """
+        left = self._receptive_frames()
+        right = 2  # the upsampling layers look one frame ahead per layer
+        frames = np.zeros((0, self.params.mgc_order))
+        noise = np.zeros((0))
+        emitted = 0  # frames[:emitted] were already vocoded
+        blocks = iter(mgc_blocks)
+        finished = False
+        while not finished or emitted < len(frames):
+            if not finished and len(frames) - emitted < chunk_size + right:
+                block = next(blocks, None)
+                if block is None:
+                    finished = True
+                else:
+                    frames = np.concatenate([frames, block])
+                continue
+
+            stop = min(emitted + chunk_size, len(frames))
+            start = max(emitted - left, 0)
+            window = frames[start:stop + right]
+            context = (emitted - start) * self.UPSAMPLE_COUNT
+            fresh = np.random.normal(size=(len(window) - (emitted - start)) * self.UPSAMPLE_COUNT) * temperature
+            z = np.concatenate([noise[len(noise) - context:], fresh])
+            with torch.no_grad():
+                c = torch.tensor(window.transpose(), dtype=torch.float32).to(device).reshape(1, window.shape[1],
+                                                                                             len(window))
+                c_up = self.model_t.upsample(c)
+                z = torch.tensor(z, dtype=torch.float32).to(device).reshape(1, 1, len(z))
+                x = self.model_s.generate(z, c_up, device=device)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            x = x.reshape(-1)[context:context + (stop - emitted) * self.UPSAMPLE_COUNT].cpu().numpy() * 32768
+
+            noise = np.concatenate([noise, fresh[:(stop - emitted) * self.UPSAMPLE_COUNT]])
+            trim = max(stop - left, 0)
+            frames = frames[trim:]
+            noise = noise[len(noise) - (stop - trim) * self.UPSAMPLE_COUNT:]
+            emitted = stop - trim
+            yield x
+
     def store(self, output_base):
         torch.save(self.model_s.state_dict(), output_base + ".network")
 
     def load(self, output_base):
         self.model_s.load_state_dict(torch.load(output_base + ".network", map_location=device))
         self.model_s.to(device)
+
+    def snapshot(self):
+        """
+        In-memory copy of the trained weights (see restore)
+        """
+        return {name: value.detach().cpu().clone() for name, value in self.model_s.state_dict().items()}
+
+    def restore(self, snapshot):
+        self.model_s.load_state_dict(snapshot)
+        self.model_s.to(device)
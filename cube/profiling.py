@@ -0,0 +1,187 @@
+#
+# Author: Tiberiu Boros
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+def parse_window(window):
+    """
+    Parses a "START:STOP" step window. Returns None for an empty window.
+    """
+    if not window:
+        return None
+    start, stop = window.split(':')
+    return int(start), int(stop)
+
+
+class Profiler:
+    """
+    Records wall and CPU time per named stage. Inside a window of steps (files, utterances or requests) it can also
+    capture a cProfile dump and a PyTorch profiler trace. Everything is written to a directory: stages.json (totals),
+    stages.trace.json and torch.trace.json (Chrome trace format, open them in chrome://tracing) and cprofile.prof.
+    Once started, first-time imports of top-level packages are also timed and reported as "import:<package>" stages.
+    When the profiler is not started, stage() and step() do nothing.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.output_dir = None
+        self.window = None
+        self.step_index = 0
+        self.totals = {}
+        self.events = []
+        self._origin = time.time()
+        self._cprofile = None
+        self._torch_profile = None
+        self._lock = threading.Lock()
+        self._import_state = threading.local()
+
+    def start(self, output_dir, window=None):
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        self.enabled = True
+        self.output_dir = output_dir
+        self.window = window
+        self.step_index = 0
+        self._origin = time.time()
+        if self.window is not None and self.window[0] <= 0:
+            self._start_capture()
+        import atexit
+        from multiprocessing import util
+        atexit.register(self.stop)
+        # worker processes started by multiprocessing skip atexit handlers, but run finalizers
+        util.Finalize(self, self.stop, exitpriority=10)
+        self._install_import_timer()
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        wall_start = time.time()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.time() - wall_start
+            cpu = time.process_time() - cpu_start
+            with self._lock:
+                total = self.totals.setdefault(name, {'count': 0, 'wall': 0.0, 'cpu': 0.0})
+                total['count'] += 1
+                total['wall'] += wall
+                total['cpu'] += cpu
+                self.events.append({'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_ident(),
+                                    'ts': (wall_start - self._origin) * 1e6, 'dur': wall * 1e6,
+                                    'args': {'cpu_ms': cpu * 1000, 'step': self.step_index}})
+
+    def _install_import_timer(self):
+        import builtins
+        original_import = builtins.__import__
+        if getattr(original_import, 'profiler', None) is self:
+            return
+
+        def timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+            package = name.partition('.')[0]
+            nested = getattr(self._import_state, 'active', False)
+            if not self.enabled or level != 0 or nested or package in sys.modules:
+                return original_import(name, globals, locals, fromlist, level)
+            # only the outermost import is timed, so nested imports are not counted twice
+            self._import_state.active = True
+            try:
+                with self.stage('import:' + package):
+                    return original_import(name, globals, locals, fromlist, level)
+            finally:
+                self._import_state.active = False
+
+        timed_import.profiler = self
+        builtins.__import__ = timed_import
+
+    def step(self):
+        """
+        Marks the end of a step (a training file, an utterance or a request)
+        """
+        if not self.enabled:
+            return
+        self.step_index += 1
+        if self.window is not None:
+            if self.step_index == self.window[0]:
+                self._start_capture()
+            elif self.step_index == self.window[1]:
+                self._stop_capture()
+
+    def _start_capture(self):
+        import cProfile
+        self._cprofile = cProfile.Profile()
+        self._cprofile.enable()
+        try:
+            import torch
+        except ImportError:
+            return
+        self._torch_profile = torch.autograd.profiler.profile()
+        self._torch_profile.__enter__()
+
+    def _stop_capture(self):
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            self._cprofile.dump_stats(os.path.join(self.output_dir, 'cprofile.prof'))
+            self._cprofile = None
+        if self._torch_profile is not None:
+            self._torch_profile.__exit__(None, None, None)
+            self._torch_profile.export_chrome_trace(os.path.join(self.output_dir, 'torch.trace.json'))
+            self._torch_profile = None
+
+    def stop(self):
+        if not self.enabled:
+            return
+        self._stop_capture()
+        with self._lock:
+            with open(os.path.join(self.output_dir, 'stages.json'), 'w') as f:
+                json.dump(self.totals, f, indent=2, sort_keys=True)
+            with open(os.path.join(self.output_dir, 'stages.trace.json'), 'w') as f:
+                json.dump({'traceEvents': self.events}, f)
+        sys.stderr.write('Profiling data written to ' + self.output_dir + '\n')
+        for name in sorted(self.totals):
+            total = self.totals[name]
+            sys.stderr.write('\t' + name + ': count=' + str(total['count']) + ' wall=' + str(
+                total['wall']) + ' cpu=' + str(total['cpu']) + '\n')
+        self.enabled = False
+
+
+class Metrics:
+    """
+    Named event counters (e.g. runaway decodes), reported by the WebService /metrics endpoint
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, count=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + count
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counters)
+
+
+profiler = Profiler()
+metrics = Metrics()
@@ -0,0 +1,269 @@
+#
+# Author: Tiberiu Boros
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import io
+import multiprocessing
+import queue
+import sys
+import threading
+import wave
+
+import numpy as np
+
+
+class SharedRingBuffer:
+    """
+    Single-producer/single-consumer ring of 16-bit PCM samples kept in shared memory. The producer (a model
+    worker) copies samples into the ring and only sends (start, count) pairs to the consumer, so the audio itself
+    never goes through a pipe.
+    """
+
+    def __init__(self, capacity, ctx=multiprocessing):
+        self.capacity = capacity
+        self._data = ctx.RawArray('h', capacity)
+        self._head = ctx.RawValue('q', 0)  # total number of samples written
+        self._tail = ctx.RawValue('q', 0)  # total number of samples released by the consumer
+        self._cond = ctx.Condition()
+        self._view = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_view'] = None
+        return state
+
+    def _samples(self):
+        if self._view is None:
+            self._view = np.frombuffer(self._data, dtype=np.int16)
+        return self._view
+
+    def write(self, pcm):
+        """
+        Copies pcm into the ring, blocking while the ring is full. It is a generator that yields a (start, count)
+        pair after each contiguous write, so the caller can notify the consumer before waiting for more room.
+        """
+        view = self._samples()
+        offset = 0
+        while offset < len(pcm):
+            with self._cond:
+                while self._head.value - self._tail.value >= self.capacity:
+                    self._cond.wait()
+                head = self._head.value
+                free = self.capacity - (head - self._tail.value)
+            pos = head % self.capacity
+            count = min(free, len(pcm) - offset, self.capacity - pos)
+            view[pos:pos + count] = pcm[offset:offset + count]
+            with self._cond:
+                self._head.value = head + count
+                self._cond.notify_all()
+            offset += count
+            yield head, count
+
+    def read(self, start, count):
+        """
+        Returns a view (not a copy) over count samples starting at start. The view stays valid until release().
+        """
+        pos = start % self.capacity
+        return self._samples()[pos:pos + count]
+
+    def release(self, count):
+        with self._cond:
+            self._tail.value += count
+            self._cond.notify_all()
+
+
+def _worker_main(params, base_path, requests, results, ring):
+    import os
+    from tuning import configure_threads
+    from profiling import profiler, parse_window, metrics
+    configure_threads(params.threads)
+    if params.profile:
+        profiler.start(os.path.join(params.profile, 'worker-' + str(os.getpid())),
+                       window=parse_window(params.profile_window))
+    from synthesis import configure_dynet, load_all_models, synthesize_text, tune_models
+    configure_dynet(params)
+
+    encoders, vocoders = load_all_models(params, base_path)
+    if len(encoders) != 0:
+        language = sorted(encoders.keys())[0]
+        tune_models(encoders[language], vocoders[language], params)
+    results.put(('ready', sorted(encoders.keys())))
+
+    while True:
+        job = requests.get()
+        if job is None:
+            break
+        language, text, speaker_identity = job
+        try:
+            signal = synthesize_text(text, encoders[language], vocoders[language], speaker_identity,
+                                     chunk_size=params.chunk_size)
+            pcm = np.clip(signal, -32768, 32767).astype(np.int16)
+            for start, count in ring.write(pcm):
+                results.put(('chunk', start, count))
+            results.put(('done', len(pcm), metrics.snapshot()))
+        except Exception as e:
+            results.put(('error', str(e)))
+
+
+class _Worker:
+    def __init__(self, process, requests, results, ring):
+        self.process = process
+        self.requests = requests
+        self.results = results
+        self.ring = ring
+        self.metrics = {}  # counters of the worker process, as of its last finished request
+
+
+class WorkerError(RuntimeError):
+    pass
+
+
+class WorkerPool:
+    """
+    Runs the models in separate processes. The front-end (Flask) process only dispatches requests and assembles the
+    WAVE response directly from the workers' shared ring buffers. A worker that dies during a request is reported as
+    an error and replaced in the background; a worker that dies while loading the models is dropped.
+    """
+
+    POLL_SECONDS = 1.0
+
+    def __init__(self, params, base_path, num_workers, buffer_size):
+        self._ctx = multiprocessing.get_context('spawn')
+        self._params = params
+        self._base_path = base_path
+        self._buffer_size = buffer_size
+        self.sample_rate = params.target_sample_rate
+        self.languages = []
+        self._workers = []
+        self._lock = threading.Lock()
+        self._idle = queue.Queue()
+
+        starting = [self._start_worker() for _ in range(num_workers)]
+        for index, worker in enumerate(starting):
+            try:
+                languages = self._wait_ready(worker)
+            except WorkerError as e:
+                sys.stdout.write('Worker ' + str(index + 1) + '/' + str(num_workers) + ' ' + str(e) + '\n')
+                continue
+            sys.stdout.write('Worker ' + str(index + 1) + '/' + str(num_workers) + ' loaded languages: ' + ', '.join(
+                languages) + '\n')
+            self.languages = languages
+            self._workers.append(worker)
+            self._idle.put(worker)
+        if len(self._workers) == 0:
+            raise WorkerError('none of the ' + str(num_workers) + ' workers could load the models')
+
+    def _start_worker(self):
+        requests = self._ctx.Queue()
+        results = self._ctx.Queue()
+        ring = SharedRingBuffer(self._buffer_size, self._ctx)
+        process = self._ctx.Process(target=_worker_main,
+                                    args=(self._params, self._base_path, requests, results, ring), daemon=True)
+        process.start()
+        return _Worker(process, requests, results, ring)
+
+    def _get_result(self, worker):
+        """
+        Next message from the worker. Raises WorkerError if the worker process exits before sending one.
+        """
+        while True:
+            try:
+                return worker.results.get(timeout=self.POLL_SECONDS)
+            except queue.Empty:
+                if not worker.process.is_alive():
+                    raise WorkerError('worker process exited with code ' + str(worker.process.exitcode))
+
+    def _wait_ready(self, worker):
+        status, languages = self._get_result(worker)
+        return languages
+
+    def _replace_worker(self, worker):
+        with self._lock:
+            if worker in self._workers:
+                self._workers.remove(worker)
+        new_worker = self._start_worker()
+        try:
+            self._wait_ready(new_worker)
+        except WorkerError as e:
+            sys.stderr.write('Could not restart a model worker: ' + str(e) + '\n')
+            return
+        with self._lock:
+            self._workers.append(new_worker)
+        self._idle.put(new_worker)
+
+    def _get_idle(self):
+        while True:
+            try:
+                return self._idle.get(timeout=self.POLL_SECONDS)
+            except queue.Empty:
+                with self._lock:
+                    if len(self._workers) == 0:
+                        raise WorkerError('no model workers are running')
+
+    def synthesize(self, language, text, speaker_identity):
+        """
+        Returns the synthesized utterance as 16-bit WAVE file content. Raises WorkerError if the worker fails.
+        """
+        worker = self._get_idle()
+        alive = True
+        try:
+            worker.requests.put((language, text, speaker_identity))
+            output = io.BytesIO()
+            wav = wave.open(output, 'wb')
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(self.sample_rate)
+            while True:
+                try:
+                    message = self._get_result(worker)
+                except WorkerError:
+                    alive = False
+                    raise
+                if message[0] == 'chunk':
+                    wav.writeframes(worker.ring.read(message[1], message[2]))
+                    worker.ring.release(message[2])
+                elif message[0] == 'done':
+                    worker.metrics = message[2]
+                    break
+                else:
+                    raise WorkerError(message[1])
+            wav.close()
+            return output.getvalue()
+        finally:
+            if alive:
+                self._idle.put(worker)
+            else:
+                sys.stderr.write('A model worker died while processing a request, restarting it\n')
+                threading.Thread(target=self._replace_worker, args=(worker,), daemon=True).start()
+
+    def metrics(self):
+        """
+        Sum of the profiling.metrics counters of all workers
+        """
+        counters = {}
+        with self._lock:
+            workers = list(self._workers)
+        for worker in workers:
+            for name, count in worker.metrics.items():
+                counters[name] = counters.get(name, 0) + count
+        return counters
+
+    def close(self):
+        with self._lock:
+            workers = list(self._workers)
+        for worker in workers:
+            worker.requests.put(None)
+        for worker in workers:
+            worker.process.join()
@@ -14,10 +14,9 @@
 # limitations under the License.
 #
 
-import dynet_config
 import optparse
 import sys
-import numpy as np
+from profiling import profiler, parse_window
 
 
 def get_file_input_old(txt_file):
@@ -39,6 +38,69 @@ def get_file_input(txt_file):
         return ' '.join(' '.join(f.readlines()).split())
 
 
+# words ending in a period that usually do not end a sentence, even when followed by a capitalized word
+ABBREVIATIONS = {'mr.', 'mrs.', 'ms.', 'dr.', 'prof.', 'st.', 'jr.', 'sr.', 'vs.', 'etc.', 'e.g.', 'i.e.', 'no.',
+                 'fig.', 'gen.', 'col.', 'capt.', 'lt.', 'sgt.', 'rev.', 'mt.', 'inc.', 'ltd.', 'co.',
+                 'dl.', 'dna.', 'dra.', 'nr.', 'str.', 'pag.', 'ing.'}
+
+
+def split_sentences(text, max_chars=300):
+    """
+    Splits a paragraph into sentences. A sentence ends at '.', '!' or '?' (possibly followed by a closing quote or
+    bracket) when the next word starts with an uppercase letter (in any script, e.g. 'Ș') or a digit, unless the period
+    belongs to a known abbreviation or an initial. Sentences longer than max_chars are further split at commas, or at
+    spaces as a last resort, so that no segment exceeds the length the encoder was trained on.
+    """
+    import re
+    sentences = []
+    for piece in re.split(r'(?:(?<=[.!?])|(?<=[.!?]["\')\]]))\s+', text):
+        if len(sentences) != 0:
+            last_word = sentences[-1].split()[-1].lower()
+            start = piece.lstrip('"\'([')
+            if not start[:1].isupper() and not start[:1].isdigit() or last_word in ABBREVIATIONS or \
+                    re.match(r'^[^\W\d_]\.$', last_word):
+                sentences[-1] += ' ' + piece
+                continue
+        sentences.append(piece)
+
+    segments = []
+    for sentence in sentences:
+        while len(sentence) > max_chars:
+            cut = sentence.rfind(',', 0, max_chars)
+            if cut <= 0:
+                cut = sentence.rfind(' ', 0, max_chars)
+            if cut <= 0:
+                cut = max_chars - 1
+            segments.append(sentence[:cut + 1].strip())
+            sentence = sentence[cut + 1:].strip()
+        if sentence != '':
+            segments.append(sentence)
+    return segments
+
+
+def get_file_segments(txt_file, max_chars=300):
+    """
+    Lazily reads a document and yields (sentence, is_last_in_paragraph) pairs. Paragraphs are separated by empty
+    lines.
+    """
+    with open(txt_file, 'rt', encoding='utf-8') as f:
+        paragraph = []
+        for line in f:
+            line = ' '.join(line.split())
+            if line != '':
+                paragraph.append(line)
+                continue
+            if len(paragraph) != 0:
+                segments = split_sentences(' '.join(paragraph), max_chars=max_chars)
+                for index, segment in enumerate(segments):
+                    yield segment, index == len(segments) - 1
+                paragraph = []
+        if len(paragraph) != 0:
+            segments = split_sentences(' '.join(paragraph), max_chars=max_chars)
+            for index, segment in enumerate(segments):
+                yield segment, index == len(segments) - 1
+
+
 def get_phone_input_from_text(text, speaker_identity):
     from io_modules.dataset import PhoneInfo
 
@@ -65,37 +127,65 @@ def create_lab_input(txt_file, speaker_ident):
     return get_phone_input_from_text(line, speaker_ident)
 
 
-def _render_spectrogram(mgc, output_file):
-    bitmap = np.zeros((mgc.shape[1], mgc.shape[0], 3), dtype=np.uint8)
-    # mgc_min = mgc.min()
-    # mgc_max = mgc.max()
-
-    for x in range(mgc.shape[0]):
-        for y in range(mgc.shape[1]):
-            val = np.clip(mgc[x, y] * 255, 0, 255)  # (mgc[x, y] - mgc_min) / (mgc_max - mgc_min)
-
-            color = val
-            bitmap[mgc.shape[1] - y - 1, x] = [color, color, color]
-    import scipy.misc as smp
-
-    img = smp.toimage(bitmap)
-    img.save(output_file)
+def configure_dynet(params, gpu=False):
+    """
+    DyNet reads its configuration when it is first imported, so this must be called before any model is loaded. The
+    NumPy encoder runs without DyNet, so nothing is done (or imported) for --encoder-engine=numpy.
+    """
+    if params.encoder_engine != 'dynet':
+        return
+    import dynet_config
+    dynet_config.set(mem=int(params.memory), random_seed=9)
+    if gpu:
+        dynet_config.set_gpu()
 
 
 def load_encoder(params, base_path='data/models'):
     from io_modules.dataset import Encodings
-    from models.encoder import Encoder
 
     encodings = Encodings()
     encodings.load('%s/encoder.encodings' % base_path)
 
-    encoder = Encoder(params, encodings, runtime=True)
-    encoder.load('%s/rnn_encoder' % base_path)
+    if params.encoder_engine == 'numpy':
+        # weights exported with scripts/export_encoder.py (or compressed with scripts/compress_encoder.py)
+        from models.encoder_numpy import NumpyEncoder
+        encoder = NumpyEncoder(params, encodings)
+        encoder.load('%s/%s' % (base_path, params.encoder_weights))
+    else:
+        from models.encoder import Encoder, read_encoder_config
+        config = read_encoder_config('%s/rnn_encoder' % base_path)
+        encoder = Encoder(params, encodings, runtime=True, frames_per_step=config['frames_per_step'])
+        encoder.load('%s/rnn_encoder' % base_path)
+    encoder.attention_window = params.attention_window
+    if params.encoder_cache > 0:
+        from models.utils import LRUCache
+        encoder.encoder_cache = LRUCache(params.encoder_cache)
 
     return encoder
 
 
-def load_vocoder(params, base_path='data/models'):
+def _file_digest(filename, block_size=1 << 20):
+    import hashlib
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_vocoder(params, base_path='data/models', cache=None):
+    """
+    Loads the parallel vocoder from base_path. If a cache dictionary is given, vocoders are indexed by the content
+    hash of their weight files and languages that ship identical weights share the same instance.
+    """
+    if cache is not None:
+        key = (_file_digest('%s/nn_vocoder.network' % base_path), _file_digest('%s/pnn_vocoder.network' % base_path))
+        if key in cache:
+            return cache[key]
+
     from models.vocoder import ParallelVocoder
     from models.vocoder import Vocoder
 
@@ -105,22 +195,51 @@ def load_vocoder(params, base_path='data/models'):
     pvocoder = ParallelVocoder(params, vocoder=vocoder)
     pvocoder.load('%s/pnn_vocoder' % base_path)
 
+    if cache is not None:
+        cache[key] = pvocoder
     return pvocoder
 
 
+def load_all_models(params, base_path='data/models'):
+    import os
+    encoders = {}
+    vocoders = {}
+    vocoder_cache = {}
+
+    for lang in sorted(os.listdir(base_path)):
+        new_path = '%s/%s' % (base_path, lang)
+        if os.path.isdir(new_path):
+            try:
+                encoder = load_encoder(params, new_path)
+                vocoder = load_vocoder(params, new_path, cache=vocoder_cache)
+
+                encoders[lang] = encoder
+                vocoders[lang] = vocoder
+            except:
+                print('Language %s does not have all models' % lang)
+
+    print('Loaded %d languages using %d distinct vocoders' % (len(encoders), len(vocoder_cache)))
+    return encoders, vocoders
+
+
 def synthesize_text_old(text, encoder, vocoder, speaker, params, output_file):
     print("[Encoding]")
-    seq = get_phone_input_from_text(text, speaker)
-    mgc, att = encoder.generate(seq)
-    _render_spectrogram(mgc, output_file + '.png')
+    with profiler.stage('encode'):
+        seq = get_phone_input_from_text(text, speaker)
+        mgc, att = encoder.generate(seq)
+    if params.render:
+        from io_modules.render import render_spectrogram
+        with profiler.stage('render'):
+            render_spectrogram(mgc, output_file + '.png')
 
     print("[Vocoding]")
 
     import time
     start = time.time()
     import torch
-    with torch.no_grad():
-        signal = vocoder.synthesize(mgc, batch_size=params.batch_size, temperature=params.temperature)
+    with profiler.stage('vocode'), torch.no_grad():
+        signal = vocoder.synthesize(mgc, batch_size=params.batch_size, temperature=params.temperature,
+                                    chunk_size=params.chunk_size)
     stop = time.time()
     sys.stdout.write(" execution time=" + str(stop - start))
     sys.stdout.write('\n')
@@ -129,13 +248,15 @@ def synthesize_text_old(text, encoder, vocoder, speaker, params, output_file):
     return signal
 
 
-def synthesize_text(text, encoder, vocoder, speaker_identity):
-    seq = get_phone_input_from_text(text, speaker_identity)
-    mgc, _ = encoder.generate(seq)
+def synthesize_text(text, encoder, vocoder, speaker_identity, chunk_size=-1):
+    with profiler.stage('encode'):
+        seq = get_phone_input_from_text(text, speaker_identity)
+        mgc, _ = encoder.generate(seq)
 
     import torch
-    with torch.no_grad():
-        signal = vocoder.synthesize(mgc, batch_size=32)
+    with profiler.stage('vocode'), torch.no_grad():
+        signal = vocoder.synthesize(mgc, batch_size=32, chunk_size=chunk_size)
+    profiler.step()
 
     return signal
 
@@ -148,19 +269,248 @@ def write_signal_to_file(signal, output_file, params):
     dio.write_wave(output_file, signal / 32768.0, params.target_sample_rate, dtype=signal.dtype)
 
 
+def tune_models(encoder, vocoder, params):
+    """
+    Applies the thread settings from params or, if --autotune is set, picks the fastest thread count and vocoder
+    chunk size for this machine. The selected values are stored back in params.
+    """
+    from tuning import autotune, set_torch_threads
+    if params.autotune:
+        params.threads, params.chunk_size = autotune(encoder, vocoder, params.threads)
+    else:
+        set_torch_threads(params.threads)
+
+
 def synthesize(speaker, input_file, output_file, params):
     from models.vocoder import device
     print(device)
     print(params)
 
-    encoder = load_encoder(params)
-    vocoder = load_vocoder(params)
+    with profiler.stage('load_models'):
+        encoder = load_encoder(params)
+        vocoder = load_vocoder(params)
+    tune_models(encoder, vocoder, params)
 
     text = get_file_input(input_file)
 
     signal = synthesize_text_old(text, encoder, vocoder, speaker, params, output_file)
 
-    write_signal_to_file(signal, output_file, params)
+    with profiler.stage('write'):
+        write_signal_to_file(signal, output_file, params)
+
+
+def _group(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if len(batch) != 0:
+        yield batch
+
+
+def synthesize_long_form(speaker, input_file, output_file, params):
+    """
+    Synthesizes a document sentence by sentence and appends the audio to the output file as it is produced, so
+    memory usage does not depend on the length of the document.
+    """
+    from io_modules.dataset import WaveWriter
+    import time
+    import torch
+
+    with profiler.stage('load_models'):
+        encoder = load_encoder(params)
+        vocoder = load_vocoder(params)
+    tune_models(encoder, vocoder, params)
+
+    sentence_pause = int(0.2 * params.target_sample_rate)
+    paragraph_pause = int(0.6 * params.target_sample_rate)
+    writer = WaveWriter(output_file, params.target_sample_rate)
+    index = 0
+    segments = get_file_segments(input_file, max_chars=params.max_segment_chars)
+    for batch in _group(segments, max(params.encoder_batch, 1)):
+        start = time.time()
+        # the encoder decodes the whole batch in lockstep; the vocoder then runs sentence by sentence
+        with profiler.stage('encode'):
+            seqs = [get_phone_input_from_text(sentence, speaker) for sentence, _ in batch]
+            outputs = encoder.generate_batch(seqs)
+        for (sentence, end_of_paragraph), (mgc, _) in zip(batch, outputs):
+            index += 1
+            sys.stdout.write('\t' + str(index) + ': ' + sentence + '\n')
+            with profiler.stage('vocode'), torch.no_grad():
+                signal = vocoder.synthesize(mgc, batch_size=32, chunk_size=params.chunk_size)
+            profiler.step()
+            with profiler.stage('write'):
+                writer.write(signal)
+                if end_of_paragraph:
+                    writer.write_silence(paragraph_pause)
+                else:
+                    writer.write_silence(sentence_pause)
+        stop = time.time()
+        sys.stdout.write('\texecution time=' + str(stop - start) + '\n')
+        sys.stdout.flush()
+    writer.close()
+
+
+def synthesize_stdin(speaker, params):
+    """
+    Long-lived mode: reads one text per line from stdin and writes raw 16-bit little-endian PCM to stdout, chunk by
+    chunk, as soon as the vocoder produces it.
+    """
+    import numpy as np
+    import torch
+
+    pcm_output = sys.stdout.buffer
+    # keep stdout clean for audio: any diagnostic message goes to stderr
+    sys.stdout = sys.stderr
+
+    with profiler.stage('load_models'):
+        encoder = load_encoder(params)
+        vocoder = load_vocoder(params)
+    tune_models(encoder, vocoder, params)
+    chunk_size = params.chunk_size
+    if chunk_size <= 0:
+        chunk_size = 100
+
+    for line in sys.stdin:
+        text = ' '.join(line.split())
+        if text == '':
+            continue
+        seq = get_phone_input_from_text(text, speaker)
+        # the vocoder pulls small mel blocks from the encoder as they are decoded, so audio starts before decoding
+        # ends; it needs chunk_size frames plus a couple of look-ahead frames for its first chunk
+        mgc_blocks = encoder.generate_stream(seq, block_size=12)
+        with profiler.stage('encode+vocode'), torch.no_grad():
+            for signal in vocoder.synthesize_stream(mgc_blocks, temperature=params.temperature, chunk_size=chunk_size):
+                pcm_output.write(np.clip(signal, -32768, 32767).astype('<i2').tobytes())
+                pcm_output.flush()
+        profiler.step()
+
+
+def read_manifest(manifest_file):
+    """
+    Lazily reads (id, speaker, text) entries from a TAB-separated manifest file
+    """
+    with open(manifest_file, 'rt', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line == '' or line.startswith('#'):
+                continue
+            parts = line.split('\t', 2)
+            if len(parts) != 3:
+                sys.stdout.write('Skipping malformed manifest line: ' + line + '\n')
+                continue
+            # the id is used as a file name inside the output folder
+            if parts[0] in ['', '.', '..'] or '/' in parts[0] or '\\' in parts[0]:
+                sys.stdout.write('Skipping manifest line with an invalid id: ' + line + '\n')
+                continue
+            yield parts[0], parts[1], ' '.join(parts[2].split())
+
+
+_manifest_models = None
+_manifest_error = None
+
+
+class ModelLoadError(Exception):
+    pass
+
+
+def _init_manifest_worker(params):
+    # an exception in a Pool initializer makes the pool restart the worker forever, so the error is reported by the
+    # first task instead
+    global _manifest_error
+    try:
+        _load_manifest_models(params)
+    except Exception:
+        import traceback
+        _manifest_error = traceback.format_exc()
+
+
+def _load_manifest_models(params):
+    global _manifest_models
+    import os
+    from tuning import configure_threads
+    configure_threads(params.threads)
+    if params.profile:
+        profiler.start(os.path.join(params.profile, 'worker-' + str(os.getpid())),
+                       window=parse_window(params.profile_window))
+    configure_dynet(params, gpu=params.gpu)
+    encoder = load_encoder(params)
+    vocoder = load_vocoder(params)
+    tune_models(encoder, vocoder, params)
+    _manifest_models = (encoder, vocoder, params)
+
+
+def _synthesize_manifest_entry(entry):
+    import os
+    if _manifest_error is not None:
+        raise ModelLoadError(_manifest_error)
+    encoder, vocoder, params = _manifest_models
+    utt_id, speaker, text = entry
+    output_file = os.path.join(params.output_folder, utt_id + '.wav')
+    signal = synthesize_text(text, encoder, vocoder, speaker, chunk_size=params.chunk_size)
+    # write under a temporary name first, so an interrupted job never leaves a truncated file that looks finished
+    with profiler.stage('write'):
+        write_signal_to_file(signal, output_file + '.tmp', params)
+        os.replace(output_file + '.tmp', output_file)
+    return utt_id
+
+
+def synthesize_manifest(params):
+    """
+    Synthesizes every entry of a manifest using a pool of processes that load the models only once. Entries whose
+    output file already exists are skipped, so an interrupted job can be resumed.
+    """
+    import os
+    import multiprocessing
+    import threading
+
+    if not os.path.exists(params.output_folder):
+        os.makedirs(params.output_folder)
+
+    def pending_entries():
+        for entry in read_manifest(params.manifest):
+            if os.path.exists(os.path.join(params.output_folder, entry[0] + '.wav')):
+                counts['skipped'] += 1
+                continue
+            yield entry
+
+    counts = {'skipped': 0, 'done': 0, 'failed': 0}
+    fatal = []
+    # bound the number of queued entries, so memory does not depend on the size of the manifest
+    slots = threading.BoundedSemaphore(params.processes * 4)
+
+    def on_done(utt_id):
+        counts['done'] += 1
+        sys.stdout.write('\r' + str(counts['done']) + ' synthesized, ' + str(counts['failed']) + ' failed, ' + str(
+            counts['skipped']) + ' skipped')
+        sys.stdout.flush()
+        slots.release()
+
+    def on_error(e):
+        if isinstance(e, ModelLoadError):
+            fatal.append(e)
+            slots.release()
+            return
+        counts['failed'] += 1
+        sys.stdout.write('\nError: ' + str(e) + '\n')
+        slots.release()
+
+    ctx = multiprocessing.get_context('spawn')
+    pool = ctx.Pool(params.processes, initializer=_init_manifest_worker, initargs=(params,))
+    for entry in pending_entries():
+        slots.acquire()
+        if len(fatal) != 0:
+            break
+        pool.apply_async(_synthesize_manifest_entry, (entry,), callback=on_done, error_callback=on_error)
+    pool.close()
+    pool.join()
+    if len(fatal) != 0:
+        sys.stdout.write('\nCould not load the models:\n' + str(fatal[0]) + '\n')
+        sys.exit(1)
+    sys.stdout.write('\r' + str(counts['done']) + ' synthesized, ' + str(counts['failed']) + ' failed, ' + str(
+        counts['skipped']) + ' skipped\n')
 
 
 if __name__ == '__main__':
@@ -185,21 +535,74 @@ if __name__ == '__main__':
                       help='Exploration parameter (max 1.0, default 0.7)', default=0.7)
     parser.add_option('--target-sample-rate', action='store', dest='target_sample_rate',
                       help='Resample input files at this rate (default=24000)', type='int', default=24000)
+    parser.add_option('--threads', action='store', dest='threads', type='int', default=0,
+                      help='Number of CPU threads shared by DyNet and PyTorch (default=0 - all available cores)')
+    parser.add_option('--chunk-size', action='store', dest='chunk_size', type='int', default=-1,
+                      help='Vocode the spectrogram in chunks of N frames (default=-1 - whole utterance)')
+    parser.add_option('--autotune', action='store_true', dest='autotune',
+                      help='Warm-up the models and select the fastest thread count and chunk size')
+    parser.add_option('--manifest', action='store', dest='manifest',
+                      help='TAB-separated file with one "id<TAB>speaker<TAB>text" entry per line')
+    parser.add_option('--output-folder', action='store', dest='output_folder',
+                      help='Where to write <id>.wav files in manifest mode')
+    parser.add_option('--processes', action='store', dest='processes', type='int', default=1,
+                      help='Number of synthesis processes in manifest mode (default=1)')
+    parser.add_option('--profile', action='store', dest='profile',
+                      help='Write per-stage wall/CPU timings (Chrome trace format) to this folder')
+    parser.add_option('--profile-window', action='store', dest='profile_window',
+                      help='Also capture cProfile and PyTorch traces for utterances START:STOP (e.g. 2:5)')
+    parser.add_option('--render', action='store_true', dest='render',
+                      help='Also render the generated spectrogram to <output file>.png')
+    parser.add_option('--stdout', action='store_true', dest='stdout',
+                      help='Read texts line by line from stdin and write raw 16-bit PCM to stdout')
+    parser.add_option('--long-form', action='store_true', dest='long_form',
+                      help='Synthesize the input file sentence by sentence and write the output incrementally')
+    parser.add_option('--max-segment-chars', action='store', dest='max_segment_chars', type='int', default=300,
+                      help='Maximum number of characters synthesized at once in long-form mode (default=300)')
+    parser.add_option('--encoder-batch', action='store', dest='encoder_batch', type='int', default=1,
+                      help='Number of sentences decoded together by the encoder in long-form mode (default=1)')
+
+    parser.add_option('--attention-window', action='store', dest='attention_window', type='int', default=0,
+                      help='Score only N characters on each side of the current attention position (default=0 - all)')
+    parser.add_option('--encoder-engine', action='store', dest='encoder_engine', choices=['dynet', 'numpy'],
+                      default='dynet', help='Run the encoder with DyNet or with the NumPy runtime (default=dynet)')
+    parser.add_option('--encoder-weights', action='store', dest='encoder_weights', default='rnn_encoder',
+                      help='Weights used by the NumPy encoder, e.g. rnn_encoder.svd (default=rnn_encoder)')
+    parser.add_option('--encoder-cache', action='store', dest='encoder_cache', type='int', default=0,
+                      help='Keep the encoder states of the last N inputs and reuse them for other speakers (default=0)')
 
     (params, _) = parser.parse_args(sys.argv)
 
-    if not params.speaker:
+    if params.manifest:
+        if not params.output_folder:
+            print("Output folder is mandatory")
+    elif params.stdout:
+        if not params.speaker:
+            sys.stderr.write("Speaker identity is mandatory\n")
+    elif not params.speaker:
         print("Speaker identity is mandatory")
     elif not params.txt_file:
         print("Input file is mandatory")
     elif not params.output_file:
         print("Output file is mandatory")
 
-    memory = int(params.memory)
     # for compatibility we have to add this paramater
     params.learning_rate = 0.0001
-    dynet_config.set(mem=memory, random_seed=9)
-    if params.gpu:
-        dynet_config.set_gpu()
-
-    synthesize(params.speaker, params.txt_file, params.output_file, params)
+    from tuning import configure_threads, cpu_count
+    if params.threads <= 0:
+        params.threads = max(cpu_count() // max(params.processes, 1), 1)
+    if params.profile and not params.manifest:
+        profiler.start(params.profile, window=parse_window(params.profile_window))
+
+    if params.manifest:
+        synthesize_manifest(params)
+    else:
+        configure_threads(params.threads)
+        configure_dynet(params, gpu=params.gpu)
+
+        if params.stdout:
+            synthesize_stdin(params.speaker, params)
+        elif params.long_form:
+            synthesize_long_form(params.speaker, params.txt_file, params.output_file, params)
+        else:
+            synthesize(params.speaker, params.txt_file, params.output_file, params)
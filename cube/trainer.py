@@ -18,15 +18,16 @@ import dynet_config
 import optparse
 import sys
 import numpy as np
+from profiling import profiler, parse_window
 
 if __name__ == '__main__':
     parser = optparse.OptionParser()
     parser.add_option('--cleanup', action='store_true', dest='cleanup',
                       help='Cleanup temporary training files and start from fresh')
     parser.add_option('--phase', action='store', dest='phase',
-                      choices=['1', '2', '3', '4'],
+                      choices=['1', '2', '3', '4', '5'],
                       help='select phase: 1 - prepare corpus; 2 - train sequential vocoder; 3 - train encoder; '
-                           '4 - train parallel vocoder')
+                           '4 - train parallel vocoder; 5 - export GTA spectrograms from the encoder')
     parser.add_option("--batch-size", action='store', dest='batch_size', default='1000', type='int',
                       help='number of samples in a single batch (default=1000)')
     parser.add_option("--set-mem", action='store', dest='memory', default='2048', type='int',
@@ -61,9 +62,42 @@ if __name__ == '__main__':
     parser.add_option('--prefix', action='store', dest='prefix', help='Use this prefix when importing files')
     parser.add_option('--output-at', type='int', dest='output_at', action='store', default=5000,
                       help='Synthesize after every N files')
+    parser.add_option('--render', action='store_true', dest='render',
+                      help='Render a spectrogram PNG for every imported file (phase 1)')
+    parser.add_option('--profile', action='store', dest='profile',
+                      help='Write per-stage wall/CPU timings (Chrome trace format) to this folder')
+    parser.add_option('--profile-window', action='store', dest='profile_window',
+                      help='Also capture cProfile and PyTorch traces for training files START:STOP (e.g. 10:20)')
+    parser.add_option('--frames-per-step', action='store', dest='frames_per_step', type='int', default=3,
+                      help='Number of mgc frames emitted by each decoder step of a new encoder (default=3)')
+    parser.add_option('--encoder-batch-size', action='store', dest='encoder_batch_size', type='int', default=1,
+                      help='Train the encoder (phase 3) or export GTA spectrograms (phase 5) on minibatches of N '
+                           'utterances of similar length (default=1)')
+    parser.add_option('--tbptt-steps', action='store', dest='tbptt_steps', type='int', default=150,
+                      help='Decoder steps per update for encoder utterances of 1400+ frames (truncated BPTT, '
+                           'default=150)')
+    parser.add_option('--loader-workers', action='store', dest='loader_workers', type='int', default=2,
+                      help='Background workers that read and parse upcoming encoder training files (default=2, '
+                           '0 - load synchronously)')
+    parser.add_option('--loader-prefetch', action='store', dest='loader_prefetch', type='int', default=8,
+                      help='Maximum number of files (or minibatches) loaded ahead of training (default=8)')
+    parser.add_option('--background-eval', action='store_true', dest='background_eval',
+                      help='Store checkpoints and synthesize the devset in a background process, without pausing '
+                           'training (phases 2, 3 and 4)')
+    parser.add_option('--workers', action='store', dest='workers', type='int', default=1,
+                      help='Train the encoder (phase 3) or export GTA spectrograms (phase 5) with N processes on CPU '
+                           '(default=1)')
+    parser.add_option('--sync-every', action='store', dest='sync_every', type='int', default=10,
+                      help='Number of files each encoder training process learns between parameter averaging '
+                           '(default=10)')
+    parser.add_option('--loader-processes', action='store_true', dest='loader_processes',
+                      help='Use worker processes instead of threads for loading the training data')
 
     (params, _) = parser.parse_args(sys.argv)
 
+    if params.profile:
+        profiler.start(params.profile, window=parse_window(params.profile_window))
+
     memory = int(params.memory)
     if params.autobatch:
         autobatch = True
@@ -83,23 +117,6 @@ if __name__ == '__main__':
         return a
 
 
-    def render_spectrogram(mgc, output_file):
-        bitmap = np.zeros((mgc.shape[1], mgc.shape[0], 3), dtype=np.uint8)
-        mgc_min = mgc.min()
-        mgc_max = mgc.max()
-
-        for x in range(mgc.shape[0]):
-            for y in range(mgc.shape[1]):
-                val = (mgc[x, y] - mgc_min) / (mgc_max - mgc_min)
-
-                color = val * 255
-                bitmap[mgc.shape[1] - y - 1, x] = [color, color, color]
-        import scipy.misc as smp
-
-        img = smp.toimage(bitmap)
-        img.save(output_file)
-
-
     def create_lab_file(txt_file, lab_file, speaker_name=None):
         fin = open(txt_file, 'r')
         fout = open(lab_file, 'w')
@@ -172,6 +189,7 @@ if __name__ == '__main__':
 
         from io_modules.dataset import DatasetIO
         from io_modules.vocoder import MelVocoder
+        from io_modules.render import render_spectrogram
         from shutil import copyfile
         dio = DatasetIO()
         vocoder = MelVocoder()
@@ -204,10 +222,13 @@ if __name__ == '__main__':
             # TXT
             copyfile(join(base_folder, txt_name), join('data/processed/train', tgt_txt_name))
             # WAVE
-            data, sample_rate = dio.read_wave(join(base_folder, wav_name), sample_rate=params.target_sample_rate)
-            mgc = vocoder.melspectrogram(data, sample_rate=params.target_sample_rate, num_mels=params.mgc_order)
+            with profiler.stage('read_wave'):
+                data, sample_rate = dio.read_wave(join(base_folder, wav_name), sample_rate=params.target_sample_rate)
+            with profiler.stage('melspectrogram'):
+                mgc = vocoder.melspectrogram(data, sample_rate=params.target_sample_rate, num_mels=params.mgc_order)
             # SPECT
-            render_spectrogram(mgc, join('data/processed/train', tgt_spc_name))
+            if params.render:
+                render_spectrogram(mgc, join('data/processed/train', tgt_spc_name), normalize=True)
             if params.prefix is None:
                 dio.write_wave(join('data/processed/train', base_name + '.orig.wav'), data, sample_rate)
                 array2file(mgc, join('data/processed/train', base_name + '.mgc'))
@@ -216,6 +237,7 @@ if __name__ == '__main__':
                 tgt_mgc_name = params.prefix + "_{:05d}".format(total_files) + '.mgc'
                 dio.write_wave(join('data/processed/train', tgt_wav_name), data, sample_rate)
                 array2file(mgc, join('data/processed/train', tgt_mgc_name))
+            profiler.step()
 
         sys.stdout.write('\n')
         base_folder = params.dev_folder
@@ -246,10 +268,13 @@ if __name__ == '__main__':
             # TXT
             copyfile(join(base_folder, txt_name), join('data/processed/dev', tgt_txt_name))
             # WAVE
-            data, sample_rate = dio.read_wave(join(base_folder, wav_name), sample_rate=params.target_sample_rate)
-            mgc = vocoder.melspectrogram(data, sample_rate=params.target_sample_rate, num_mels=params.mgc_order)
+            with profiler.stage('read_wave'):
+                data, sample_rate = dio.read_wave(join(base_folder, wav_name), sample_rate=params.target_sample_rate)
+            with profiler.stage('melspectrogram'):
+                mgc = vocoder.melspectrogram(data, sample_rate=params.target_sample_rate, num_mels=params.mgc_order)
             # SPECT
-            render_spectrogram(mgc, join('data/processed/dev', tgt_spc_name))
+            if params.render:
+                render_spectrogram(mgc, join('data/processed/dev', tgt_spc_name), normalize=True)
             if params.prefix is None:
                 dio.write_wave(join('data/processed/dev', base_name + '.orig.wav'), data, sample_rate)
                 array2file(mgc, join('data/processed/dev', base_name + '.mgc'))
@@ -258,6 +283,7 @@ if __name__ == '__main__':
                 tgt_mgc_name = params.prefix + "_{:05d}".format(total_files) + '.mgc'
                 dio.write_wave(join('data/processed/dev', tgt_wav_name), data, sample_rate)
                 array2file(mgc, join('data/processed/dev', tgt_mgc_name))
+            profiler.step()
 
         sys.stdout.write('\n')
 
@@ -275,13 +301,13 @@ if __name__ == '__main__':
         sys.stdout.write('Found ' + str(len(trainset.files)) + ' training files and ' + str(
             len(devset.files)) + ' development files\n')
         trainer = Trainer(vocoder, trainset, devset)
-        trainer.start_training(20, params.batch_size, params.target_sample_rate)
+        trainer.start_training(20, params.batch_size, params.target_sample_rate, params=params)
 
 
     def phase_3_train_encoder(params):
         from io_modules.dataset import Dataset
         from io_modules.dataset import Encodings
-        from models.encoder import Encoder
+        from models.encoder import Encoder, read_encoder_config
         from trainers.encoder import Trainer
         trainset = Dataset("data/processed/train")
         devset = Dataset("data/processed/dev")
@@ -312,7 +338,12 @@ if __name__ == '__main__':
             runtime = True  # avoid ortonormal initialization
         else:
             runtime = False
-        encoder = Encoder(params, encodings, runtime=runtime)
+        frames_per_step = params.frames_per_step
+        if params.resume:
+            # the number of output projections must match the stored model
+            frames_per_step = read_encoder_config('data/models/rnn_encoder')['frames_per_step']
+        sys.stdout.write('Decoding ' + str(frames_per_step) + ' frames per step\n')
+        encoder = Encoder(params, encodings, runtime=runtime, frames_per_step=frames_per_step)
         if params.resume:
             sys.stdout.write('Resuming from previous checkpoint\n')
             encoder.load('data/models/rnn_encoder')
@@ -321,7 +352,12 @@ if __name__ == '__main__':
         if params.no_bounds:
             sys.stdout.write('Using internal stopping condition for synthesis\n')
         trainer = Trainer(encoder, trainset, devset)
-        trainer.start_training(10, 1000, params)
+        if params.workers > 1:
+            if params.gpu:
+                sys.stdout.write('Data-parallel training runs on CPU, ignoring --use-gpu in the training processes\n')
+            trainer.start_parallel_training(params)
+        else:
+            trainer.start_training(10, 1000, params)
 
 
     def phase_4_train_pvocoder(params):
@@ -345,6 +381,16 @@ if __name__ == '__main__':
         trainer.start_training(20, params.batch_size, params.target_sample_rate, params=params)
 
 
+    def phase_5_export_gta(params):
+        from io_modules.dataset import Dataset
+        from trainers.gta import export_gta
+        trainset = Dataset("data/processed/train")
+        devset = Dataset("data/processed/dev")
+        sys.stdout.write('Found ' + str(len(trainset.files)) + ' training files and ' + str(
+            len(devset.files)) + ' development files\n')
+        export_gta(params, trainset.files + devset.files)
+
+
     if params.phase and params.phase == '1':
         phase_1_prepare_corpus(params)
     if params.phase and params.phase == '2':
@@ -353,3 +399,5 @@ if __name__ == '__main__':
         phase_3_train_encoder(params)
     if params.phase and params.phase == '4':
         phase_4_train_pvocoder(params)
+    if params.phase and params.phase == '5':
+        phase_5_export_gta(params)
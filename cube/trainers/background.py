@@ -0,0 +1,73 @@
+#
+# Author: Tiberiu Boros
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import sys
+
+
+def atomic_store(model, output_base):
+    """
+    Stores the model to temporary files and renames them over the previous checkpoint once they are complete, so an
+    interrupted write never leaves a truncated checkpoint behind
+    """
+    temp_base = output_base + '.tmp'
+    model.store(temp_base)
+    for suffix in ['.network', '.conf']:
+        if os.path.exists(temp_base + suffix):
+            os.replace(temp_base + suffix, output_base + suffix)
+
+
+class BackgroundEvaluator:
+    """
+    Checkpointing and devset synthesis in a separate process. The training thread only takes an in-memory snapshot of
+    the model (model.snapshot()); the evaluation process restores it into its own copy of the model, writes the
+    checkpoint and synthesizes the devset. setup_func(*setup_args) is called once in the evaluation process and must
+    return a function evaluate(snapshot, synthesize). Only the latest snapshot matters: if the evaluation process is
+    still busy, a pending snapshot is replaced by the newer one.
+    """
+
+    def __init__(self, setup_func, setup_args):
+        import multiprocessing
+        # the evaluation process configures DyNet/PyTorch on its own
+        context = multiprocessing.get_context('spawn')
+        self.queue = context.Queue(1)
+        self.process = context.Process(target=_evaluation_loop, args=(setup_func, setup_args, self.queue))
+        self.process.daemon = True
+        self.process.start()
+
+    def submit(self, model, synthesize=True):
+        import queue
+        snapshot = model.snapshot()
+        try:
+            self.queue.get_nowait()
+            sys.stdout.write('\tBackground evaluation is still running, dropping the previous snapshot\n')
+        except queue.Empty:
+            pass
+        self.queue.put((snapshot, synthesize))
+
+    def close(self):
+        self.queue.put(None)
+        self.process.join()
+
+
+def _evaluation_loop(setup_func, setup_args, queue):
+    evaluate = setup_func(*setup_args)
+    while True:
+        task = queue.get()
+        if task is None:
+            break
+        snapshot, synthesize = task
+        evaluate(snapshot, synthesize)
@@ -16,7 +16,38 @@
 
 import sys
 import numpy as np
-from io_modules.dataset import DatasetIO
+from io_modules.dataset import DataLoader, DatasetIO, load_utterance, load_utterances
+from io_modules.render import render_attention, render_spectrogram
+from profiling import profiler
+
+
+def read_lengths(files):
+    """
+    Number of frames of each file, read from the header of <file>.mgc.npy
+    """
+    return {file: np.load(file + '.mgc.npy', mmap_mode='r').shape[0] for file in files}
+
+
+def length_batches(files, batch_size, lengths, shuffle=True):
+    """
+    Splits the files into batches of utterances with similar lengths, so that little computation is spent on padding.
+    With shuffle, the files are sorted within large random buckets only and the batches are returned in random order,
+    to keep some randomness in the batch composition; otherwise all files are sorted by length.
+    """
+    import random
+    files = list(files)
+    bucket_size = len(files)
+    if shuffle:
+        random.shuffle(files)
+        bucket_size = batch_size * 50
+    batches = []
+    for bucket_start in range(0, len(files), max(bucket_size, 1)):
+        bucket = sorted(files[bucket_start:bucket_start + bucket_size], key=lambda file: lengths[file])
+        for batch_start in range(0, len(bucket), batch_size):
+            batches.append(bucket[batch_start:batch_start + batch_size])
+    if shuffle:
+        random.shuffle(batches)
+    return batches
 
 
 class Trainer:
@@ -24,6 +55,8 @@ class Trainer:
         self.vocoder = vocoder
         self.trainset = trainset
         self.devset = devset
+        self.lengths = None  # number of frames of each training file, used for bucketing
+        self.background = None  # trainers.background.BackgroundEvaluator, with --background-eval
 
     def array2file(self, a, filename):
         np.save(filename, a)
@@ -45,30 +78,10 @@ class Trainer:
             mgc, att = self.vocoder.generate(phones, max_size=max_size)
 
             self.array2file(mgc, 'data/output/' + file[file.rfind('/') + 1:] + '.mgc')
-            att = [a.value() for a in att]
-            new_att = np.zeros((len(att), len(phones) + 2, 3), dtype=np.uint8)
-
-            for ii in range(len(phones) + 2):
-                for jj in range(len(att)):
-                    val = np.clip(int(att[jj][ii] * 255), 0, 255)
-                    new_att[jj, ii, 0] = val
-                    new_att[jj, ii, 1] = val
-                    new_att[jj, ii, 2] = val
-
-            from PIL import Image
-            img = Image.fromarray(new_att, 'RGB')
-            img.save('data/output/' + file[file.rfind('/') + 1:] + 'att.png')
+            render_attention(att, 'data/output/' + file[file.rfind('/') + 1:] + 'att.png')
 
             output_file = 'data/output/' + file[file.rfind('/') + 1:] + '.png'
-            bitmap = np.zeros((mgc.shape[1], mgc.shape[0], 3), dtype=np.uint8)
-            for x in range(mgc.shape[0]):
-                for y in range(mgc.shape[1]):
-                    val = mgc[x, y]
-                    color = np.clip(val * 255, 0, 255)
-                    bitmap[mgc.shape[1] - y - 1, x] = [color, color, color]#bitmap[y, x] = [color, color, color]
-            import scipy.misc as smp
-            img = smp.toimage(bitmap)
-            img.save(output_file)
+            render_spectrogram(mgc, output_file)
             stop = time.time()
             sys.stdout.write(" execution time=" + str(stop - start))
             sys.stdout.write('\n')
@@ -86,71 +99,259 @@ class Trainer:
             mgc = np.load(mgc_file)
             #print mgc.shape
             output_file = 'data/output/' + file[file.rfind('/') + 1:] + '.png'
-            bitmap = np.zeros((mgc.shape[1], mgc.shape[0], 3), dtype=np.uint8)
-            for x in range(mgc.shape[0]):
-                for y in range(mgc.shape[1]):
-                    val = mgc[x, y]
-                    val = val + 2 * self.stdev[y]
-                    val = val / 4
-                    if val < 0:
-                        val = 0
-                    if val > 1:
-                        val = 1
-                    color = val * 255
-                    bitmap[y, x] = [color, color, color]
-            import scipy.misc as smp
-            img = smp.toimage(bitmap)
-            img.save(output_file)
+            render_spectrogram(mgc, output_file)
+
+    def _length_batches(self, batch_size):
+        if self.lengths is None:
+            self.lengths = read_lengths(self.trainset.files)
+        return length_batches(self.trainset.files, batch_size, self.lengths)
+
+    def _checkpoint(self, max_mgc):
+        if self.background is not None:
+            # the evaluation process stores the snapshot and synthesizes the devset while training goes on
+            with profiler.stage('snapshot'):
+                self.background.submit(self.vocoder)
+            return
+        with profiler.stage('synth_devset'):
+            self.synth_devset(max_size=max_mgc)
+        with profiler.stage('store'):
+            self.vocoder.store('data/models/rnn_encoder')
+
+    def _start_background(self, params, max_mgc):
+        from trainers.background import BackgroundEvaluator
+        sys.stdout.write('Storing and synthesizing the devset in a background process\n')
+        self.background = BackgroundEvaluator(_background_evaluation,
+                                              (params, self.vocoder.FRAMES_PER_STEP, max_mgc))
+
+    def _learn_file(self, phones, mgc, params):
+        if len(mgc) < 1400:
+            with profiler.stage('learn'):
+                return self.vocoder.learn(phones, mgc, guided_att=not params.no_guided_attention)
+        # too long for a single graph, the decoder is unrolled in windows of tbptt_steps steps
+        sys.stdout.write(' truncated BPTT')
+        with profiler.stage('learn'):
+            return self.vocoder.learn_truncated(phones, mgc, params.tbptt_steps,
+                                                guided_att=not params.no_guided_attention)
+
+    def _loader(self, items, load_func, params):
+        return DataLoader(items, load_func, num_workers=params.loader_workers, prefetch=params.loader_prefetch,
+                          processes=params.loader_processes)
+
+    def _train_batches(self, params, max_mgc):
+        batches = self._length_batches(params.encoder_batch_size)
+        loader = self._loader(batches, load_utterances, params)
+        file_index = 0
+        for batch_index, (files, examples) in enumerate(loader):
+            sys.stdout.write(
+                "\t" + str(batch_index + 1) + "/" + str(len(batches)) + " processing " + str(len(files)) + " files")
+            sys.stdout.flush()
+
+            batch = []
+            long_files = []
+            for phones, mgc in examples:
+                if len(mgc) < 1400:
+                    batch.append((phones, mgc))
+                else:
+                    long_files.append((phones, mgc))
+            if len(long_files) != 0:
+                sys.stdout.write(' (' + str(len(long_files)) + ' long files with truncated BPTT)')
+
+            import time
+            start = time.time()
+            loss = 0
+            if len(batch) != 0:
+                with profiler.stage('learn'):
+                    loss = self.vocoder.learn_batch(batch, guided_att=not params.no_guided_attention)
+            for phones, mgc in long_files:
+                with profiler.stage('learn'):
+                    self.vocoder.learn_truncated(phones, mgc, params.tbptt_steps,
+                                                 guided_att=not params.no_guided_attention)
+            stop = time.time()
+            sys.stdout.write(' avg loss=' + str(loss) + " execution time=" + str(stop - start))
+            sys.stdout.write('\n')
+            sys.stdout.flush()
+            profiler.step()
+
+            previous_index = file_index
+            file_index += len(files)
+            if file_index // 500 != previous_index // 500:
+                self._checkpoint(max_mgc)
 
     def start_training(self, itt_no_improve, batch_size, params):
         epoch = 1
         left_itt = itt_no_improve
-        dio = DatasetIO()
 
         if params.no_bounds:
             max_mgc = -1
         else:
             max_mgc = 1000
-        self.synth_devset(max_size=max_mgc)
-        self.vocoder.store('data/models/rnn_encoder')
+        if params.background_eval:
+            self._start_background(params, max_mgc)
+        self._checkpoint(max_mgc)
         while left_itt > 0:
             sys.stdout.write("Starting epoch " + str(epoch) + "\n")
             sys.stdout.write("Shuffling training data\n")
             from random import shuffle
             shuffle(self.trainset.files)
-            file_index = 1
-            total_loss = 0
-            for file in self.trainset.files:
-                sys.stdout.write(
-                    "\t" + str(file_index) + "/" + str(len(self.trainset.files)) + " processing file " + file)
-                sys.stdout.flush()
+            if params.encoder_batch_size > 1:
+                self._train_batches(params, max_mgc)
+            else:
+                file_index = 1
+                total_loss = 0
+                # the next files are read and parsed in the background while the current one is trained on
+                for file, (phones, mgc) in self._loader(self.trainset.files, load_utterance, params):
+                    sys.stdout.write(
+                        "\t" + str(file_index) + "/" + str(len(self.trainset.files)) + " processing file " + file)
+                    sys.stdout.flush()
 
-                mgc_file = file + ".mgc.npy"
-                mgc = np.load(mgc_file)
+                    file_index += 1
 
-                lab_file = file + ".lab"
-                lab = dio.read_lab(lab_file)
-                phones = lab
+                    import time
+                    start = time.time()
+                    loss = self._learn_file(phones, mgc, params)
+                    total_loss += loss
+                    stop = time.time()
+                    sys.stdout.write(' avg loss=' + str(loss) + " execution time=" + str(stop - start))
+                    sys.stdout.write('\n')
+                    sys.stdout.flush()
+                    profiler.step()
+                    if file_index % 500 == 0:
+                        self._checkpoint(max_mgc)
 
-                file_index += 1
+            self._checkpoint(max_mgc)
 
-                import time
-                start = time.time()
-                if len(mgc) < 1400:
-                    loss = self.vocoder.learn(phones, mgc, guided_att=not params.no_guided_attention)
-                else:
-                    sys.stdout.write(' too long, skipping')
-                    loss = 0
-                total_loss += loss
-                stop = time.time()
-                sys.stdout.write(' avg loss=' + str(loss) + " execution time=" + str(stop - start))
-                sys.stdout.write('\n')
-                sys.stdout.flush()
-                if file_index % 500 == 0:
-                    self.synth_devset(max_size=max_mgc)
-                    self.vocoder.store('data/models/rnn_encoder')
+            epoch += 1
 
+    def start_parallel_training(self, params):
+        """
+        Data-parallel training on CPU: params.workers processes train on disjoint shards of the training set and
+        average their parameters every params.sync_every files. Worker 0 synthesizes the devset and stores the model.
+        """
+        import multiprocessing
+        from models.utils import get_parameter_values
+
+        if params.no_bounds:
+            max_mgc = -1
+        else:
+            max_mgc = 1000
+        with profiler.stage('synth_devset'):
             self.synth_devset(max_size=max_mgc)
+        # workers start from the stored model
+        with profiler.stage('store'):
             self.vocoder.store('data/models/rnn_encoder')
 
+        # workers import DyNet with their own configuration, so they must not be forked from this process
+        context = multiprocessing.get_context('spawn')
+        num_values = get_parameter_values(self.vocoder.model).shape[0]
+        shared = context.RawArray('f', num_values * params.workers)
+        barrier = context.Barrier(params.workers)
+        sys.stdout.write('Starting ' + str(params.workers) + ' training processes (' + str(
+            num_values) + ' parameters, averaged every ' + str(params.sync_every) + ' files)\n')
+        workers = [context.Process(target=_parallel_worker, args=(rank, params, shared, barrier))
+                   for rank in range(params.workers)]
+        for worker in workers:
+            worker.start()
+        from multiprocessing.connection import wait
+        running = list(workers)
+        while len(running) != 0:
+            wait([worker.sentinel for worker in running])
+            running = [worker for worker in running if worker.exitcode is None]
+            failed = [rank for rank, worker in enumerate(workers) if worker.exitcode not in (None, 0)]
+            if len(failed) != 0:
+                # a worker that was killed could not release the others, which are waiting for it at the barrier
+                barrier.abort()
+                for worker in running:
+                    worker.terminate()
+                for worker in workers:
+                    worker.join()
+                raise RuntimeError('Training process ' + str(failed[0]) + ' exited with code ' + str(
+                    workers[failed[0]].exitcode))
+
+    def _average_parameters(self, rank, slots, barrier):
+        from models.utils import get_parameter_values, set_parameter_values
+        slots[rank] = get_parameter_values(self.vocoder.model)
+        barrier.wait()
+        set_parameter_values(self.vocoder.model, slots.mean(axis=0))
+        # nobody may overwrite its slot before all workers have read the average
+        barrier.wait()
+
+    def _train_worker(self, rank, params, shared, barrier):
+        from random import Random
+        num_workers = params.workers
+        slots = np.frombuffer(shared, dtype=np.float32).reshape(num_workers, -1)
+        if params.no_bounds:
+            max_mgc = -1
+        else:
+            max_mgc = 1000
+        if rank == 0 and params.background_eval:
+            self._start_background(params, max_mgc)
+        files = sorted(self.trainset.files)
+        # every worker must do the same number of steps, otherwise the barriers would deadlock
+        num_steps = len(files) // num_workers
+        epoch = 1
+        while True:
+            if rank == 0:
+                sys.stdout.write("Starting epoch " + str(epoch) + "\n")
+            # the same permutation in all workers, so that the shards are disjoint
+            shuffled = list(files)
+            Random(epoch).shuffle(shuffled)
+            shard = shuffled[rank::num_workers][:num_steps]
+            import time
+            synced_files = 0
+            for index, (file, (phones, mgc)) in enumerate(self._loader(shard, load_utterance, params)):
+                start = time.time()
+                loss = self._learn_file(phones, mgc, params)
+                stop = time.time()
+                if rank == 0:
+                    sys.stdout.write("\t" + str((index + 1) * num_workers) + "/" + str(
+                        num_steps * num_workers) + " processing file " + file + ' avg loss=' + str(
+                        loss) + " execution time=" + str(stop - start) + '\n')
+                    sys.stdout.flush()
+                if (index + 1) % params.sync_every == 0 or index + 1 == num_steps:
+                    self._average_parameters(rank, slots, barrier)
+                    if rank == 0 and (index + 1) * num_workers // 500 != synced_files // 500:
+                        self._checkpoint(max_mgc)
+                    synced_files = (index + 1) * num_workers
+            if rank == 0:
+                self._checkpoint(max_mgc)
             epoch += 1
+
+
+def _parallel_worker(rank, params, shared, barrier):
+    import dynet_config
+    dynet_config.set(mem=int(params.memory), random_seed=9 + rank, autobatch=bool(params.autobatch))
+    from io_modules.dataset import Dataset, Encodings
+    from models.encoder import Encoder, read_encoder_config
+
+    encodings = Encodings()
+    encodings.load('data/models/encoder.encodings')
+    frames_per_step = read_encoder_config('data/models/rnn_encoder')['frames_per_step']
+    encoder = Encoder(params, encodings, runtime=True, frames_per_step=frames_per_step)
+    encoder.load('data/models/rnn_encoder')
+    trainer = Trainer(encoder, Dataset("data/processed/train"), Dataset("data/processed/dev"))
+    try:
+        trainer._train_worker(rank, params, shared, barrier)
+    finally:
+        # the other workers would otherwise wait for this one at the next barrier forever
+        barrier.abort()
+
+
+def _background_evaluation(params, frames_per_step, max_mgc):
+    import dynet_config
+    dynet_config.set(mem=int(params.memory), random_seed=9)
+    from io_modules.dataset import Dataset, Encodings
+    from models.encoder import Encoder
+    from trainers.background import atomic_store
+
+    encodings = Encodings()
+    encodings.load('data/models/encoder.encodings')
+    encoder = Encoder(params, encodings, runtime=True, frames_per_step=frames_per_step)
+    trainer = Trainer(encoder, None, Dataset("data/processed/dev"))
+
+    def evaluate(snapshot, synthesize):
+        encoder.restore(snapshot)
+        atomic_store(encoder, 'data/models/rnn_encoder')
+        if synthesize:
+            trainer.synth_devset(max_size=max_mgc)
+
+    return evaluate
@@ -0,0 +1,86 @@
+#
+# Author: Tiberiu Boros
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import sys
+import time
+
+import numpy as np
+
+# encoder of the current (worker) process
+_encoder = None
+
+
+def _load_encoder(params, configure_dynet=True):
+    global _encoder
+    if configure_dynet:
+        import dynet_config
+        dynet_config.set(mem=int(params.memory), random_seed=9)
+    from io_modules.dataset import Encodings
+    from models.encoder import Encoder, read_encoder_config
+
+    encodings = Encodings()
+    encodings.load('data/models/encoder.encodings')
+    frames_per_step = read_encoder_config('data/models/rnn_encoder')['frames_per_step']
+    _encoder = Encoder(params, encodings, runtime=True, frames_per_step=frames_per_step)
+    _encoder.load('data/models/rnn_encoder')
+
+
+def _export_batch(files):
+    from io_modules.dataset import load_utterances
+    batch = load_utterances(files)
+    outputs = _encoder.predict_teacher_forced_batch(batch)
+    for file, output in zip(files, outputs):
+        # written to a temporary file first, so an interrupted export never leaves a truncated array behind
+        np.save(file + '.gta.tmp.npy', output.astype(np.float16))
+        os.replace(file + '.gta.tmp.npy', file + '.gta.npy')
+    return len(files), sum(len(output) for output in outputs)
+
+
+def export_gta(params, files):
+    """
+    Writes the ground-truth-aligned (teacher-forced) encoder output of each file to <file>.gta.npy (float16, same
+    shape as <file>.mgc.npy). Batches of params.encoder_batch_size files are decoded by params.workers processes.
+    Files that already have an output are skipped.
+    """
+    pending = [file for file in files if not os.path.exists(file + '.gta.npy')]
+    sys.stdout.write('Exporting GTA spectrograms for ' + str(len(pending)) + ' files (' + str(
+        len(files) - len(pending)) + ' already done)\n')
+    from trainers.encoder import length_batches, read_lengths
+    batches = length_batches(pending, max(params.encoder_batch_size, 1), read_lengths(pending), shuffle=False)
+
+    start = time.time()
+    num_files = 0
+    num_frames = 0
+    if params.workers > 1:
+        import multiprocessing
+        context = multiprocessing.get_context('spawn')
+        pool = context.Pool(params.workers, initializer=_load_encoder, initargs=(params,))
+        results = pool.imap_unordered(_export_batch, batches)
+    else:
+        pool = None
+        _load_encoder(params, configure_dynet=False)
+        results = (_export_batch(batch) for batch in batches)
+    for batch_files, batch_frames in results:
+        num_files += batch_files
+        num_frames += batch_frames
+        sys.stdout.write('\r\t' + str(num_files) + '/' + str(len(pending)) + ' files, ' + str(
+            int(num_frames / max(time.time() - start, 1e-6))) + ' frames/s')
+        sys.stdout.flush()
+    if pool is not None:
+        pool.close()
+        pool.join()
+    sys.stdout.write('\n')
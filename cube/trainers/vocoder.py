@@ -17,6 +17,8 @@
 import sys
 import numpy as np
 from io_modules.dataset import DatasetIO
+from io_modules.render import render_spectrogram
+from profiling import profiler
 
 
 class Trainer:
@@ -26,6 +28,7 @@ class Trainer:
         self.devset = devset
         self.use_ulaw = use_ulaw
         self.target_output_path = target_output_path
+        self.background = None  # trainers.background.BackgroundEvaluator, with --background-eval
 
     def synth_devset(self, batch_size, target_sample_rate, sample=True, temperature=1.0):
         sys.stdout.write('\tSynthesizing devset\n')
@@ -62,15 +65,18 @@ class Trainer:
             mgc = np.load(mgc_file)
             # print mgc.shape
             output_file = 'data/output/' + file[file.rfind('/') + 1:] + '.png'
-            bitmap = np.zeros((mgc.shape[1], mgc.shape[0], 3), dtype=np.uint8)
-            for x in range(mgc.shape[0]):
-                for y in range(mgc.shape[1]):
-                    val = mgc[x, y]
-                    color = val * 255
-                    bitmap[y, x] = [color, color, color]
-            import scipy.misc as smp
-            img = smp.toimage(bitmap)
-            img.save(output_file)
+            render_spectrogram(mgc, output_file, flip=False)
+
+    def _checkpoint(self, batch_size, target_sample_rate):
+        if self.background is not None:
+            # the evaluation process stores the snapshot and synthesizes the devset while training goes on
+            with profiler.stage('snapshot'):
+                self.background.submit(self.vocoder)
+            return
+        with profiler.stage('store'):
+            self.vocoder.store(self.target_output_path)
+        with profiler.stage('synth_devset'):
+            self.synth_devset(batch_size, target_sample_rate)
 
     def start_training(self, itt_no_improve, batch_size, target_sample_rate, params=None):
         epoch = 1
@@ -80,6 +86,13 @@ class Trainer:
         sys.stdout.write("\n")
         # self.synth_devset(batch_size, target_sample_rate)
         self.vocoder.store(self.target_output_path)
+        if params is not None and params.background_eval:
+            from models.vocoder import ParallelVocoder
+            from trainers.background import BackgroundEvaluator
+            sys.stdout.write('Storing and synthesizing the devset in a background process\n')
+            self.background = BackgroundEvaluator(_background_evaluation, (
+                params, isinstance(self.vocoder, ParallelVocoder), self.target_output_path, batch_size,
+                target_sample_rate))
 
         num_files = 0
         while left_itt > 0:
@@ -94,27 +107,49 @@ class Trainer:
                 sys.stdout.write(
                     "\t" + str(file_index) + "/" + str(len(self.trainset.files)) + " processing file " + file + '\n')
                 sys.stdout.flush()
-                wav_file = file + ".orig.wav"
-                mgc_file = file + ".mgc.npy"
-                mgc = np.load(mgc_file)
-                file_index += 1
-                data, sample_rate = dio.read_wave(wav_file)
-                # wave_disc = data * 32768
-                wave_disc = np.array(data, dtype=np.float32)
+                with profiler.stage('load'):
+                    wav_file = file + ".orig.wav"
+                    mgc_file = file + ".mgc.npy"
+                    mgc = np.load(mgc_file)
+                    file_index += 1
+                    data, sample_rate = dio.read_wave(wav_file)
+                    # wave_disc = data * 32768
+                    wave_disc = np.array(data, dtype=np.float32)
 
                 import time
                 start = time.time()
-                loss = self.vocoder.learn(wave_disc, mgc, batch_size)
+                with profiler.stage('learn'):
+                    loss = self.vocoder.learn(wave_disc, mgc, batch_size)
                 total_loss += loss
                 stop = time.time()
                 sys.stdout.write(' avg loss=' + str(loss) + " execution time=" + str(stop - start))
                 sys.stdout.write('\n')
                 sys.stdout.flush()
+                profiler.step()
                 if file_index % params.output_at == 0:
-                    self.vocoder.store(self.target_output_path)
-                    self.synth_devset(batch_size, target_sample_rate)
+                    self._checkpoint(batch_size, target_sample_rate)
 
-            self.vocoder.store(self.target_output_path)
-            self.synth_devset(batch_size, target_sample_rate)
+            self._checkpoint(batch_size, target_sample_rate)
 
             epoch += 1
+
+
+def _background_evaluation(params, parallel, output_path, batch_size, target_sample_rate):
+    from io_modules.dataset import Dataset
+    from models.vocoder import Vocoder, ParallelVocoder
+    from trainers.background import atomic_store
+
+    vocoder = Vocoder(params)
+    if parallel:
+        # the student needs the (fixed) teacher
+        vocoder.load('data/models/nn_vocoder')
+        vocoder = ParallelVocoder(params, vocoder)
+    trainer = Trainer(vocoder, None, Dataset("data/processed/dev"), target_output_path=output_path)
+
+    def evaluate(snapshot, synthesize):
+        vocoder.restore(snapshot)
+        atomic_store(vocoder, output_path)
+        if synthesize:
+            trainer.synth_devset(batch_size, target_sample_rate)
+
+    return evaluate
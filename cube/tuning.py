@@ -0,0 +1,111 @@
+#
+# Author: Tiberiu Boros
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import sys
+import time
+
+WARMUP_TEXT = 'This is a short sentence used to warm up the models.'
+
+
+def cpu_count():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+
+
+def configure_threads(num_threads):
+    """
+    Caps the OpenMP/MKL thread pools shared by DyNet and PyTorch. It must be called before either framework is
+    imported, because their thread pools are created at import time.
+    """
+    for var in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+        os.environ[var] = str(num_threads)
+
+
+def set_torch_threads(num_threads):
+    import torch
+    torch.set_num_threads(num_threads)
+    try:
+        # DyNet and PyTorch never run at the same time, so inter-op threads would only oversubscribe the cores
+        torch.set_num_interop_threads(1)
+    except (AttributeError, RuntimeError):
+        pass
+
+
+def _thread_options(max_threads):
+    options = []
+    num_threads = 1
+    while num_threads < max_threads:
+        options.append(num_threads)
+        num_threads *= 2
+    options.append(max_threads)
+    return options
+
+
+def warmup(encoder, vocoder, speaker_identity=None, max_size=300):
+    """
+    Runs a synthetic utterance through the encoder and the vocoder and returns the generated mel spectrogram
+    """
+    from synthesis import get_phone_input_from_text
+    import torch
+
+    if speaker_identity is None:
+        speaker_identity = sorted(encoder.encodings.speaker2int.keys())[0][len('SPEAKER:'):]
+    seq = get_phone_input_from_text(WARMUP_TEXT, speaker_identity)
+    mgc, _ = encoder.generate(seq, max_size=max_size)
+    with torch.no_grad():
+        vocoder.synthesize(mgc, batch_size=32)
+    return mgc
+
+
+def autotune(encoder, vocoder, max_threads, chunk_options=(-1, 50, 100, 200), repeats=2):
+    """
+    Warms up the models and benchmarks the vocoder for a few thread counts and chunk sizes. The fastest setting is
+    applied and returned as (num_threads, chunk_size).
+    """
+    import numpy as np
+    import torch
+
+    sys.stdout.write('Warming up models\n')
+    mgc = warmup(encoder, vocoder)
+    if len(mgc) < 200:
+        mgc = np.concatenate([mgc] * (200 // max(len(mgc), 1) + 1))[:200]
+
+    best = None
+    for num_threads in _thread_options(max_threads):
+        set_torch_threads(num_threads)
+        for chunk_size in chunk_options:
+            elapsed = None
+            for _ in range(repeats):
+                start = time.time()
+                with torch.no_grad():
+                    vocoder.synthesize(mgc, batch_size=32, chunk_size=chunk_size)
+                stop = time.time()
+                if elapsed is None or stop - start < elapsed:
+                    elapsed = stop - start
+            sys.stdout.write(
+                '\tthreads=' + str(num_threads) + ' chunk_size=' + str(chunk_size) + ' execution time=' + str(
+                    elapsed) + '\n')
+            if best is None or elapsed < best[0]:
+                best = (elapsed, num_threads, chunk_size)
+
+    _, num_threads, chunk_size = best
+    sys.stdout.write('Selected threads=' + str(num_threads) + ' chunk_size=' + str(chunk_size) + '\n')
+    set_torch_threads(num_threads)
+    return num_threads, chunk_size
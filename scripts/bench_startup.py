@@ -0,0 +1,84 @@
+#
+# Author: Tiberiu Boros
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Startup-time benchmark. Each module is imported in a fresh interpreter and the time is compared against a budget.
+# The script also checks that heavy dependencies are not loaded at import time. It exits with a non-zero code if any
+# budget is exceeded, so it can be used as a CI gate:
+#
+#   python3 scripts/bench_startup.py [--repeats 5] [--scale 1.0]
+
+import optparse
+import os
+import subprocess
+import sys
+
+# module -> budget in seconds
+BUDGETS = {
+    'synthesis': 0.3,
+    'WebService': 1.0,
+    'io_modules.dataset': 0.3,
+    'io_modules.vocoder': 0.3,
+    'io_modules.render': 0.3,
+}
+HEAVY_MODULES = ['dynet', 'torch', 'librosa', 'scipy']
+
+PROBE = """
+import sys, time
+start = time.time()
+import %s
+elapsed = time.time() - start
+loaded = [m for m in %r if m in sys.modules]
+print('%%f %%s' %% (elapsed, ','.join(loaded)))
+"""
+
+
+def measure(module, cube_folder):
+    output = subprocess.check_output([sys.executable, '-c', PROBE % (module, HEAVY_MODULES)], cwd=cube_folder)
+    parts = output.decode('utf-8').strip().split('\n')[-1].split(' ')
+    loaded = parts[1].split(',') if len(parts) > 1 and parts[1] != '' else []
+    return float(parts[0]), loaded
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('--repeats', action='store', dest='repeats', type='int', default=5,
+                      help='Number of measurements per module; the fastest one is used (default=5)')
+    parser.add_option('--scale', action='store', dest='scale', type='float', default=1.0,
+                      help='Multiply all budgets by this factor for slower machines (default=1.0)')
+    (params, _) = parser.parse_args(sys.argv)
+
+    cube_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cube')
+    failed = False
+    for module in sorted(BUDGETS):
+        budget = BUDGETS[module] * params.scale
+        try:
+            results = [measure(module, cube_folder) for _ in range(params.repeats)]
+        except subprocess.CalledProcessError:
+            sys.stdout.write(module + ': import failed\n')
+            failed = True
+            continue
+        elapsed = min(result[0] for result in results)
+        loaded = results[0][1]
+        status = 'ok'
+        if elapsed > budget:
+            status = 'over budget'
+            failed = True
+        if len(loaded) != 0:
+            status = 'eagerly imports ' + ', '.join(loaded)
+            failed = True
+        sys.stdout.write(module + ': import time=' + str(elapsed) + ' budget=' + str(budget) + ' ' + status + '\n')
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,156 @@
+#
+# Author: Tiberiu Boros
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Compresses the decoder LSTM and the output projections of an exported encoder (see scripts/export_encoder.py) and
+# reports the accuracy loss on the development set:
+#
+#   python3 scripts/compress_encoder.py --method=svd --rank=256
+#   python3 scripts/compress_encoder.py --method=int8
+#
+# The result is written to data/models/rnn_encoder.<method>.npz. To use it, run synthesis.py or WebService.py with
+# --encoder-engine=numpy --encoder-weights=rnn_encoder.<method>
+
+import optparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cube'))
+
+
+def compressed_names(weights):
+    """
+    Matrices that are used at every decoder step: the merged [Wx Wh] matrix of each decoder layer, hid_w and proj_w_*
+    """
+    names = ['hid_w'] + sorted(name for name in weights if name.startswith('proj_w_'))
+    layer = 0
+    while 'decoder.' + str(layer) + '.Wx' in weights:
+        names.append('decoder.' + str(layer) + '.W')
+        layer += 1
+    return names
+
+
+def quantize_int8(matrix):
+    scale = np.abs(matrix).max(axis=1) / 127.0
+    scale[scale == 0] = 1.0
+    q = np.round(matrix / scale.reshape(-1, 1)).astype(np.int8)
+    return {'.q': q, '.scale': scale.astype(np.float32)}
+
+
+def factorize(matrix, rank):
+    if rank * (matrix.shape[0] + matrix.shape[1]) >= matrix.size:
+        # not smaller than the original matrix
+        return None
+    u, s, v = np.linalg.svd(matrix.astype(np.float64), full_matrices=False)
+    return {'.u': (u[:, :rank] * s[:rank]).astype(np.float32), '.v': v[:rank].astype(np.float32)}
+
+
+def compress(weights, method, rank):
+    output = dict(weights)
+    for name in compressed_names(weights):
+        if name.endswith('.W'):
+            prefix = name[:-1]
+            matrix = np.concatenate([output.pop(prefix + 'Wx'), output.pop(prefix + 'Wh')], axis=1)
+        else:
+            matrix = output.pop(name)
+        if method == 'int8':
+            parts = quantize_int8(matrix)
+        else:
+            parts = factorize(matrix, rank)
+        if parts is None:
+            sys.stdout.write('\t' + name + ' ' + str(matrix.shape) + ': kept\n')
+            output[name] = matrix
+            continue
+        sys.stdout.write('\t' + name + ' ' + str(matrix.shape) + ': ' + ', '.join(
+            name + key + str(parts[key].shape) for key in sorted(parts)) + '\n')
+        for key in parts:
+            output[name + key] = parts[key]
+    return output
+
+
+def evaluate(models_folder, weight_names, dev_folder, num_files):
+    """
+    Teacher-forced L1 error per frame on the development set, for each set of weights
+    """
+    from io_modules.dataset import Dataset, DatasetIO, Encodings
+    from models.encoder_numpy import NumpyEncoder
+
+    encodings = Encodings()
+    encodings.load(os.path.join(models_folder, 'encoder.encodings'))
+    encoders = []
+    for weight_name in weight_names:
+        encoder = NumpyEncoder(None, encodings)
+        encoder.load(os.path.join(models_folder, weight_name))
+        encoders.append(encoder)
+
+    dio = DatasetIO()
+    files = Dataset(dev_folder).files[:num_files]
+    errors = [0.0 for _ in encoders]
+    elapsed = [0.0 for _ in encoders]
+    num_frames = 0
+    for file in files:
+        lab = dio.read_lab(file + '.lab')
+        mgc = np.load(file + '.mgc.npy')
+        for index, encoder in enumerate(encoders):
+            start = time.time()
+            output = encoder.predict_teacher_forced(lab, mgc)
+            elapsed[index] += time.time() - start
+            errors[index] += np.abs(output - mgc[:len(output)]).sum(axis=1).sum()
+        num_frames += len(mgc)
+    return [error / max(num_frames, 1) for error in errors], elapsed, len(files)
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('--models-folder', action='store', dest='models_folder', default='data/models',
+                      help='Folder with encoder.encodings and rnn_encoder.npz (default=data/models)')
+    parser.add_option('--method', action='store', dest='method', choices=['int8', 'svd'], default='svd',
+                      help='int8 (per-row scaled 8-bit weights: 4x less memory, same compute) or svd (low-rank '
+                           'factorization, less memory and compute; default)')
+    parser.add_option('--rank', action='store', dest='rank', type='int', default=256,
+                      help='Rank of the factorized matrices for --method=svd (default=256)')
+    parser.add_option('--dev-folder', action='store', dest='dev_folder', default='data/processed/dev',
+                      help='Development set used to report the accuracy delta (default=data/processed/dev)')
+    parser.add_option('--dev-files', action='store', dest='dev_files', type='int', default=50,
+                      help='Number of development files to evaluate (default=50, 0 - skip the evaluation)')
+    (params, _) = parser.parse_args(sys.argv)
+
+    input_name = 'rnn_encoder'
+    output_name = 'rnn_encoder.' + params.method
+    input_file = os.path.join(params.models_folder, input_name + '.npz')
+    output_file = os.path.join(params.models_folder, output_name + '.npz')
+    if not os.path.exists(input_file):
+        print('Could not find ' + input_file + ', run scripts/export_encoder.py first')
+        sys.exit(1)
+
+    data = np.load(input_file)
+    weights = {name: data[name] for name in data.files}
+    sys.stdout.write('Compressing ' + input_file + ' (' + params.method + ')\n')
+    np.savez(output_file, **compress(weights, params.method, params.rank))
+    sys.stdout.write('Model size: ' + str(os.path.getsize(input_file)) + ' -> ' + str(
+        os.path.getsize(output_file)) + ' bytes, written to ' + output_file + '\n')
+
+    if params.dev_files > 0:
+        sys.stdout.write('Evaluating on ' + params.dev_folder + '\n')
+        (original, compressed), (original_time, compressed_time), num_files = evaluate(
+            params.models_folder, [input_name, output_name], params.dev_folder, params.dev_files)
+        sys.stdout.write('\tfiles=' + str(num_files) + '\n')
+        sys.stdout.write('\toriginal:   L1/frame=' + str(original) + ' execution time=' + str(original_time) + '\n')
+        sys.stdout.write(
+            '\tcompressed: L1/frame=' + str(compressed) + ' execution time=' + str(compressed_time) + '\n')
+        sys.stdout.write('\tdelta: L1/frame=' + str(compressed - original) + '\n')
@@ -0,0 +1,47 @@
+#
+# Author: Tiberiu Boros
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Exports the weights of a trained encoder (rnn_encoder.network) to rnn_encoder.npz, which is used by
+# synthesis.py and WebService.py with --encoder-engine=numpy:
+#
+#   python3 scripts/export_encoder.py [--models-folder data/models] [--mgc-order 80]
+
+import optparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cube'))
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('--models-folder', action='store', dest='models_folder', default='data/models',
+                      help='Folder with encoder.encodings and rnn_encoder.network (default=data/models)')
+    parser.add_option('--mgc-order', action='store', dest='mgc_order', type='int',
+                      help='Order of MGC parameters (default=80)', default=80)
+    (params, _) = parser.parse_args(sys.argv)
+    # for compatibility we have to add these paramaters
+    params.learning_rate = 0.0001
+    params.encoder_engine = 'dynet'
+    params.attention_window = 0
+    params.encoder_cache = 0
+    params.encoder_weights = 'rnn_encoder'
+
+    from synthesis import load_encoder
+
+    encoder = load_encoder(params, params.models_folder)
+    output_base = os.path.join(params.models_folder, 'rnn_encoder')
+    encoder.export(output_base)
+    sys.stdout.write('Encoder weights written to ' + output_base + '.npz\n')